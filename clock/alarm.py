@@ -3,19 +3,36 @@
 
 """
 import os
+import errno
 import json
 from optparse import OptionParser
-from threading import Timer
 import re
 import time
 import sys
+from datetime import datetime
 import atexit
 import signal
 import logging
+from functools import partial
+
+from config import ConfigError, load_config
+from config_watch import ConfigWatcher
+from control import ControlError, ControlServer, NotRunning, TIMEOUT, request
+from cron import compile_filter
+from player import Player
+from scheduler import HeapScheduler
+from timing_wheel import WheelScheduler
 
 # make sure the access right
 CONFIG_FILE = '/Users/eacon/github/python-tools/clock/clock.json'
 PID_FILE = '/tmp/eacon-alarm.pid'
+SOCKET_FILE = '/tmp/eacon-alarm.sock'
+# scheduler backends, the timing wheel is for very many clocks
+SCHEDULERS = {'heap': HeapScheduler, 'wheel': WheelScheduler}
+# seconds late a clock still rings, e.g. after suspend; later it waits for its next time
+MISFIRE_GRACE = 300
+# clock time, HH:MM[:SS]
+_TIME = re.compile(r'^(\d+):(\d+)(?::(\d+))?$')
 LOG_FILE = '/var/log/eacon-alarm.log'
 
 logging.basicConfig(
@@ -32,7 +49,7 @@ def main():
         from apscheduler_alarm import SchedClocks
         if SchedClocks.is_available():
             # redirect _run_clocks() method
-            _run_clocks = SchedClocks.run_clocks
+            _run_clocks = partial(SchedClocks.run_clocks, run_clocks)
         else:
             raise NotImplementedError
     except (ImportError, NotImplementedError):
@@ -41,14 +58,21 @@ def main():
     options = parse_args()
     if options.list_clock:
         LOG.info('List all alarm...')
-        list_clocks()
+        list_clocks(options.run_label)
+        return
     if options.status:
         show_status()
+        return
+    if options.snooze is not None:
+        LOG.info('Snooze {} minutes...'.format(options.snooze))
+        snooze(options.snooze)
+        return
 
     if options.reload_conf:
         LOG.info('Reload...')
-        stop_clocks()
-        # defaults to daemon
+        if reload_clocks():
+            return
+        # nothing is running, start it, defaults to daemon
         if not options.daemonize:
             options.daemonize = True
         # if not specified, defaults to run all
@@ -68,13 +92,11 @@ def main():
     save_pid(PID_FILE)
     if options.run_all_clock:
         LOG.info('Run all alarm...')
-        _run_clocks('all')
-        # loop_forever(24 * 60 * 60, _run_clocks, func_args=['all'])
+        _run_clocks('all', backend=options.backend)
         return
     if options.run_label is not None:
         LOG.info('Run alarm with label: {}'.format(options.run_label))
-        _run_clocks(str(options.run_label))
-        # loop_forever(24 * 60 * 60, _run_clocks, func_args=[str(options.run_label)])
+        _run_clocks(str(options.run_label), backend=options.backend)
         return
 
 
@@ -99,22 +121,32 @@ def parse_args():
     parser.add_option('-d', '--daemon', dest='daemonize', action='store_true', default=False,
                       help='run as daemon')
     parser.add_option('--status', dest='status', action='store_true', default=False,
-                      help='show status')
+                      help='show status, armed clocks and their next time')
+    parser.add_option('--scheduler', dest='backend', type='choice', choices=sorted(SCHEDULERS), default='heap',
+                      help='scheduler backend: heap, or wheel for very many clocks')
+    parser.add_option('--snooze', dest='snooze', metavar='MINUTES', type='float',
+                      help='stop ringing, ring again in MINUTES')
     (options, args) = parser.parse_args()
     return options
 
 
 def load_conf():
-    """"""
-    with open(CONFIG_FILE) as f:
-        clock_dict = json.load(f)
-        return clock_dict
+    """
+    :return: Config of clock.json, validated and indexed by label
+    :raise ConfigError:
+    """
+    return load_config(CONFIG_FILE)
 
 
-def list_clocks():
-    """"""
-    clocks = load_conf()
-    print json.dumps(clocks, indent=4)
+def list_clocks(label=None):
+    """
+    :param label: list only the clocks of label, None for the whole file
+    """
+    config = load_conf()
+    if label is None:
+        print json.dumps(config.conf, indent=4)
+    else:
+        print json.dumps(config.clocks_of(label), indent=4)
 
 
 def loop_forever(interval, func, func_args=None, func_kwargs=None, callback=None):
@@ -150,57 +182,156 @@ def loop_forever(interval, func, func_args=None, func_kwargs=None, callback=None
                 break
 
 
-def run_clocks(label='all'):
+def run_clocks(label='all', store=None, backend='heap'):
     """
-    start all clocks
+    start all clocks, each one re-arms itself after ringing; clock.json is
+    watched and reloaded in place, so this runs until stopped
     :param label: specified label, as a filter
+    :param store: JobStore of apscheduler_alarm.py, clocks resume from it
+    :param backend: one of SCHEDULERS
     :return:
     """
-    conf = load_conf()
-    clocks = [Clock(clock, conf) for clock in conf['clocks']]
-    clocks = [c for c in clocks if c.status == 'on']
-    if label.lower() != 'all':
-        clocks = [c for c in clocks if c.label.lower() == label.lower()]
-    for c in clocks:
-        c.start()
-    for c in clocks:
-        c.join()
-    LOG.info("All clocks are done! Existing main thread...")
-    stop_clocks()
+    # the main thread is the scheduler thread
+    scheduler = SCHEDULERS[backend]()
+    clocks = ClockSet(scheduler, label, store)
+    clocks.load()
+
+    def shutdown():
+        scheduler.stop()
+        return os.getpid()
+
+    # requests are answered in the scheduler thread, between two rings
+    server = ControlServer(SOCKET_FILE, {
+        'list': clocks.armed,
+        'snooze': clocks.snooze,
+        'stop': clocks.stop_ringing,
+        'reload': clocks.load,
+        'stats': clocks.stats,
+        'shutdown': shutdown,
+    }, call=lambda func: scheduler.call(func, timeout=TIMEOUT / 2.0))
+    server.start()
+    # reloads run in the scheduler thread too, between two rings
+    watcher = ConfigWatcher(CONFIG_FILE, lambda: scheduler.add(time.time(), clocks.load, name='reload'))
+    watcher.start()
+    signal.signal(signal.SIGHUP, lambda signum, frame: watcher.poke())
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    try:
+        scheduler.run()
+    finally:
+        server.close()
+        watcher.stop()
+        clocks.player.stop()
+    LOG.info("Scheduler is stopped! Existing main thread...")
+
+
+def _signal_daemon(signum):
+    """
+    :return: True if the running process got the signal
+    """
+    try:
+        with open(PID_FILE) as f:
+            pid = int(f.read())
+    except (IOError, ValueError):
+        return False
+    try:
+        os.kill(pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        LOG.info('Removing stale pid file...')
+        os.remove(PID_FILE)
+        return False
+    return True
+
+
+def reload_clocks():
+    """
+    make the running process reload clock.json, it drops and re-arms only the
+    changed clocks
+    :return: False if no process is running
+    """
+    LOG.info('Ask running process to reload...')
+    try:
+        result = request(SOCKET_FILE, 'reload')
+    except NotRunning:
+        return _signal_daemon(signal.SIGHUP)
+    except ControlError as e:
+        print 'Reload failed, clocks are kept: {}'.format(e)
+        return True
+    print 'Clocks reloaded: {added} added, {removed} removed, {kept} kept'.format(**result)
+    return True
 
 
 def stop_clocks():
     """
-    actually kill the process
+    stop the running process, it removes its pid file on exit
     :return:
     """
-    LOG.info('Start killing process...')
-    with open(PID_FILE) as f:
-        os.kill(int(f.read()), signal.SIGKILL)
-    LOG.info('Removing pid file...')
-    os.remove(PID_FILE)
-    LOG.info('Process is killed!')
+    LOG.info('Start stopping process...')
+    try:
+        pid = request(SOCKET_FILE, 'shutdown')
+    except NotRunning:
+        # running without control socket, or not at all
+        if not _signal_daemon(signal.SIGTERM):
+            print 'Alarm is inactive.'
+            return
+    except ControlError as e:
+        print 'Stop failed: {}'.format(e)
+        return
+    else:
+        LOG.info('Process {} is stopping!'.format(pid))
+    print 'Alarm is stopping.'
 
 
 def show_status():
     """
-    see whether the clock is on
+    see whether the clock is on, and what it is going to do
     :return:
     """
-    if os.path.exists(PID_FILE):
-        print 'Alarm is active.'
-    else:
+    try:
+        stats = request(SOCKET_FILE, 'stats')
+        armed = request(SOCKET_FILE, 'list')
+    except NotRunning:
+        # running without control socket, or not at all
+        if os.path.exists(PID_FILE):
+            print 'Alarm is active.'
+        else:
+            print 'Alarm is inactive.'
+        return
+    print 'Alarm is active. pid: {pid}, up: {uptime:.0f}s, rings: {rings}, loads of clock.json: {loads}'.format(**stats)
+    print 'Late by {late_mean:.3f}s on average, {late_max:.3f}s at most; misfires: {misfires}, ' \
+          'clock jumps: {clock_jumps}'.format(**stats['accuracy'])
+    for clock in armed:
+        print '{:<20} {:<12} {}'.format(clock['next'], clock['label'], clock['name'])
+
+
+def snooze(minutes):
+    """
+    stop the clock ringing, ring it again later
+    :return:
+    """
+    try:
+        result = request(SOCKET_FILE, 'snooze', minutes=minutes)
+    except NotRunning:
         print 'Alarm is inactive.'
+    except ControlError as e:
+        print e
+    else:
+        print '{name} rings again at {next}'.format(**result)
 
 
 def stop_music():
     """
-    stop ringing music
+    stop ringing music, by the running process
     :return:
     """
-    LOG.info('Kill playing music...')
-    CMD = """ps aux|grep afplay|grep -v "grep"|awk '{print $2}'|xargs kill -9"""
-    os.system(CMD)
+    try:
+        stopped = request(SOCKET_FILE, 'stop')
+    except NotRunning:
+        # players are children of the running process
+        print 'Alarm is inactive.'
+        return
+    LOG.info('Stopped {} player(s)'.format(stopped))
 
 
 def daemonize():
@@ -238,47 +369,229 @@ def save_pid(pid_file):
         atexit.register(os.remove, pid_file)
 
 
+class ClockSet(object):
+    """
+    the armed clocks of a label, keyed by their settings, so a reload only
+    touches clocks which were added, removed or changed
+    """
+
+    def __init__(self, scheduler, label='all', store=None):
+        self.scheduler = scheduler
+        self.label = label
+        self.store = store
+        self.clocks = {}
+        self.started = time.time()
+        self.loads = 0
+        self.player = Player('null')
+
+    def load(self):
+        """
+        (re)load clock.json; if it cannot be read or a clock is wrong the armed
+        clocks are kept
+        :return: {'added': n, 'removed': n, 'kept': n}
+        :raise ConfigError:
+        """
+        config = load_conf()
+        conf = config.conf
+        self.player.use(conf.get('player', 'auto'))
+        clocks = []
+        for clock in config.clocks_on(self.label):
+            try:
+                clocks.append(Clock(clock, conf, self.player, self.store))
+            except ValueError as e:
+                raise ConfigError('clock.json: clock {}: {}'.format(clock.get('name') or clock.get('time'), e))
+        new = dict((c.key, c) for c in clocks)
+        removed = [key for key in self.clocks if key not in new]
+        added = [key for key in new if key not in self.clocks]
+        for key in removed:
+            self.clocks.pop(key).stop(self.scheduler)
+            if self.store is not None:
+                self.store.forget(key)
+        for key in added:
+            self.clocks[key] = new[key]
+            new[key].start(self.scheduler)
+        if self.store is not None:
+            if not self.loads:
+                self.store.prune(new, self._owns)
+            self.store.commit()
+        result = {'added': len(added), 'removed': len(removed), 'kept': len(self.clocks) - len(added)}
+        LOG.info('Clocks loaded: {added} added, {removed} removed, {kept} kept'.format(**result))
+        self.loads += 1
+        return result
+
+    def _owns(self, key):
+        """whether a Clock.key is of the label run, the label is its 5th item"""
+        return self.label.lower() == 'all' or key[4].lower() == self.label.lower()
+
+    def armed(self):
+        """
+        :return: [{'name', 'label', 'deadline', 'next'}], by deadline
+        """
+        armed = []
+        for c in self.clocks.values():
+            for deadline in c.deadlines():
+                armed.append({'name': c.name, 'label': c.label, 'deadline': deadline,
+                              'next': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(deadline))})
+        armed.sort(key=lambda clock: clock['deadline'])
+        return armed
+
+    def snooze(self, minutes=5):
+        """
+        stop ringing, the clock which rang last rings again after minutes
+        :return: {'name', 'next'}
+        """
+        rang = [c for c in self.clocks.values() if c.last_rang is not None]
+        if not rang:
+            raise ValueError('No clock has rung yet')
+        c = max(rang, key=lambda clock: clock.last_rang)
+        self.player.stop()
+        deadline = c.snooze(self.scheduler, float(minutes) * 60)
+        return {'name': c.name, 'next': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(deadline))}
+
+    def stop_ringing(self):
+        """
+        :return: number of players stopped
+        """
+        return self.player.stop()
+
+    def stats(self):
+        """"""
+        return {
+            'pid': os.getpid(),
+            'uptime': time.time() - self.started,
+            'clocks': len(self.clocks),
+            'armed': len(self.scheduler),
+            'rings': sum(c.rings for c in self.clocks.values()),
+            'loads': self.loads,
+            'player': self.player.backend,
+            'playing': len(self.player.playing()),
+            'accuracy': self.scheduler.stats(),
+        }
+
+
 class Clock(object):
     """
-    Each clock instance as a thread
+    Each clock instance as a job of the scheduler
     """
 
-    def __init__(self, clock, defaults):
-        self._ringtone_folder = clock.get('ringtone_folder', defaults['default_ringtone_folder'])
-        self._ringtone = clock.get('ringtone', defaults['default_ringtone'])
-        self._filter = clock.get('filter', defaults['default_filter'])
+    # one per armed clock, settings are parsed and checked once here
+    __slots__ = ('_name', '_time', '_filter', '_status', '_label', '_music_path', '_grace', '_key', '_schedule',
+                 '_player', '_store', '_job', '_snooze_job', 'rings', 'last_rang')
+
+    def __init__(self, clock, defaults, player, store=None):
+        """
+        :raise ValueError: for a wrong time or filter
+        """
+        self._name = clock.get('name', None)
+        self._time = clock.get('time', None)
+        self._filter = tuple(clock.get('filter', defaults['default_filter']))
         self._status = clock.get('status', defaults['default_status'])
         self._label = clock.get('label', defaults['default_label'])
-        self._time = clock.get('time', None)
-        self._name = clock.get('name', None)
-        self._thread = None
-
-    def start(self):
-        """start a new thread(Timer)"""
-        countdown, next_day = self.get_count_down(self._time)
-        music_path = os.path.join(self._ringtone_folder, self._ringtone)
-        if self.filter_day(next_day=next_day):
-            t = self._thread = Timer(countdown, self.play_music, [music_path])  # new thread
-            if self._name:
-                t.setName(str(self._name))  # custom name
-            else:
-                t.setName(str(self._time))  # named by its clock time
-            t.setDaemon(True)  # make sure it die with MainThread
-            LOG.debug(
-                'Clock(id:{})-Thread: name:{}, ident:{}, interval:{}, isAlive:{}, isDaemon:{}, '.format(
-                    id(self), t.getName(), t.ident, t.interval, t.isAlive(), t.isDaemon()
-                )
-            )
-            t.start()
-            LOG.info('A new clock(id:{}) is started! Clock time:{}, ringtone: {}'.format(
-                id(self), self._time, music_path
-            ))
-        else:
+        self._music_path = os.path.join(clock.get('ringtone_folder', defaults['default_ringtone_folder']),
+                                        clock.get('ringtone', defaults['default_ringtone']))
+        self._grace = clock.get('misfire_grace', defaults.get('default_misfire_grace', MISFIRE_GRACE))
+        self._key = (self._name, self._time, self._filter, self._status, self._label, self._music_path,
+                     self._grace)
+        # compiled once, next_fire() only scans bits
+        self._schedule = compile_filter(self._filter, self._seconds_of_day(self._time))
+        self._player = player
+        self._store = store
+        self._job = None
+        self._snooze_job = None
+        self.rings = 0
+        self.last_rang = None
+
+    def start(self, scheduler, after=None):
+        """
+        arm the clock on the scheduler, for its next time
+        :param scheduler:
+        :param after: unix time, defaults to now, when the stored next time is
+            taken if there is one
+        :return:
+        """
+        deadline = None
+        if after is None and self._store is not None:
+            deadline = self._store.resume(self.key, time.time(), self._grace)
+        if deadline is None:
+            deadline = self.next_fire(time.time() if after is None else after)
+        if deadline is None:
             LOG.info('Clock(id:{}) is ignored!'.format(id(self)))
+            return
+        if self._store is not None:
+            self._store.armed(self.key, self.name, deadline)
+        job = self._job = scheduler.add(deadline, self.ring, [scheduler], name=self.name,
+                                        grace=self._grace, on_misfire=self.missed, timed=True)
+        LOG.debug('Clock(id:{})-Job: name:{}, deadline:{}, armed jobs:{}'.format(
+            id(self), job.name, job.deadline, len(scheduler)
+        ))
+        LOG.info('A new clock(id:{}) is started! Clock time:{}, next: {}, ringtone: {}'.format(
+            id(self), self._time, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(deadline)), self.music_path
+        ))
+
+    def stop(self, scheduler):
+        """"""
+        for job in (self._job, self._snooze_job):
+            if job is not None:
+                scheduler.cancel(job)
+        self._job = self._snooze_job = None
+        LOG.info('Clock(id:{}) is stopped!'.format(id(self)))
+
+    def ring(self, scheduler):
+        """play, then re-arm for the next time"""
+        if self._store is not None:
+            # marked first, a crash while ringing does not ring it twice
+            self._store.fired(self.key, self._job.deadline)
+        self.rings += 1
+        self.last_rang = time.time()
+        self.play_music(self.music_path)
+        self.rearm(scheduler)
+
+    def missed(self, scheduler):
+        """later than the grace window: no ring, re-arm for the next time"""
+        LOG.warning('Clock(id:{}) missed its time: {}'.format(
+            id(self), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self._job.deadline))
+        ))
+        if self._store is not None:
+            self._store.fired(self.key, self._job.deadline)
+        self.rearm(scheduler)
+
+    def rearm(self, scheduler):
+        """"""
+        # from now on if it was late, times passed meanwhile are not caught up one by one
+        self.start(scheduler, after=max(self._job.deadline, time.time()))
+        if self._store is not None:
+            self._store.commit()
+
+    def snooze(self, scheduler, seconds):
+        """
+        ring once more after seconds, the next time stays armed
+        :return: unix time it rings
+        """
+        if self._snooze_job is not None:
+            scheduler.cancel(self._snooze_job)
+        self._snooze_job = scheduler.add(time.time() + seconds, self.play_music, [self.music_path],
+                                         name='{} (snoozed)'.format(self.name), timed=True)
+        return self._snooze_job.deadline
 
-    def join(self):
-        if self._thread:
-            self._thread.join()
+    def deadlines(self):
+        """unix times it is armed for"""
+        return [job.deadline for job in (self._job, self._snooze_job) if job is not None and job.armed]
+
+    @property
+    def name(self):
+        """custom name, its clock time, or its filter"""
+        if self._name:
+            return str(self._name)
+        return str(self._time) if self._time else ', '.join(self._filter)
+
+    @property
+    def key(self):
+        """all settings, equal for an unchanged clock"""
+        return self._key
+
+    @property
+    def music_path(self):
+        return self._music_path
 
     @property
     def label(self):
@@ -288,65 +601,47 @@ class Clock(object):
     def status(self):
         return self._status
 
-    def filter_day(self, next_day=False):
-        """filter day"""
-        _, _, _, _, _, _, tm_wday, _, _ = time.localtime()
-        if next_day:
-            tm_wday += 1
-            tm_wday %= tm_wday
-        d = {
-            'mon': [0],
-            'tue': [1],
-            'wed': [2],
-            'thu': [3],
-            'fri': [4],
-            'sat': [5],
-            'sun': [6],
-            'weekday': range(5),
-            'weekend': range(5, 7),
-            'everyday': range(7),
-        }
-        for _ in self._filter:
-            if tm_wday in d.get(_.lower(), []):
-                return True
-        return False
-
-    def get_count_down(self, time_str):
+    @staticmethod
+    def _seconds_of_day(clock_time):
         """
-        count alarm time from now
-        :param time_str:
-        :type time_str: str
-        :return:
+        :param clock_time: 'HH:MM:SS' or 'HH:MM', None for a clock of cron filters only
+        :return: seconds since midnight
+        :raise ValueError:
         """
-        _, _, _, tm_hour, tm_min, tm_sec, _, _, _ = time.localtime()
-        now_timestamp = sum((tm_sec, tm_min * 60, tm_hour * 60 * 60))
-
-        if re.match(r'\d+:\d+:\d+', time_str):
-            h, m, s = time_str.split(':')
-        elif re.match(r'\d+:\d+', time_str):
-            h, m = time_str.split(':')
-            s = 0
-        else:
-            raise TypeError("Wrong type for time:" + str(time_str))
-        clock_timestamp = sum((int(s), int(m) * 60, int(h) * 60 * 60))
-
-        if clock_timestamp >= now_timestamp:
-            countdown = clock_timestamp - now_timestamp
-            next_day = False
-        else:
-            # that means clock time is passed today, will count to next day
-            countdown = 24 * 60 * 60 - (now_timestamp - clock_timestamp)
-            next_day = True
-        LOG.debug('Clock(id:{}) countdown seconds: {}'.format(id(self), countdown))
-        return countdown, next_day
+        if clock_time is None:
+            return None
+        m = _TIME.match(str(clock_time))
+        if not m:
+            raise ValueError("Wrong time: " + str(clock_time))
+        h, m, s = (int(v or 0) for v in m.groups())
+        if h > 23 or m > 59 or s > 59:
+            raise ValueError("Wrong time: " + str(clock_time))
+        return h * 3600 + m * 60 + s
+
+    def next_fire(self, after):
+        """
+        next time later than after, passing the filter
+        :param after: unix time
+        :return: unix time, None if the filter passes no time
+        """
+        dt = datetime.fromtimestamp(after)
+        while True:
+            dt = self._schedule.next_fire(dt)
+            if dt is None:
+                return None
+            # mktime() applies DST of that day, the hour repeated at its end maps back
+            deadline = time.mktime(dt.timetuple())
+            if deadline > after:
+                LOG.debug('Clock(id:{}) countdown seconds: {}'.format(id(self), deadline - after))
+                return deadline
 
     def play_music(self, music_path):
         """
-        actually play music, by "afplay"
+        actually play music, by the player of the clock set
         :param music_path:
         :return:
         """
-        os.system("afplay {_musix_path} &".format(_musix_path=music_path))
+        self._player.play(music_path)
         LOG.info('Clock(id:{}) is playing music: {}'.format(id(self), music_path))
 
 
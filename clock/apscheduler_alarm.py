@@ -1,18 +1,117 @@
-import apscheduler
+#!/usr/bin/env python
+"""
+Clocks resumed from a job store
 
+The next fire time and the last fired time of every clock are kept in a local
+SQLite file. A restarted daemon arms the stored next fire times as they are,
+and a clock whose time is marked fired is not rung again.
+"""
+import json
+import logging
+import os
 
-class SchedClocks(object):
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+STORE_FILE = os.path.expanduser('~/.eacon-alarm.sqlite')
+
+LOG = logging.getLogger(__name__)
+
+
+class JobStore(object):
+    """
+    next and last fired time by clock key; used from the scheduler thread
+    only, writes are kept until commit()
+    """
+
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS clocks ('
+                         'key TEXT PRIMARY KEY, name TEXT, next_fire REAL, last_fired REAL)')
+        self._db.commit()
+
+    def resume(self, key, now, grace=0):
+        """
+        :param key: Clock.key
+        :param now: unix time
+        :param grace: seconds a time missed while stopped is still rung, None for any
+        :return: stored next fire time if it is not fired, and ahead or missed
+            by less than grace, else None
+        """
+        row = self._db.execute('SELECT next_fire, last_fired FROM clocks WHERE key = ?',
+                               (_key(key),)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        next_fire, last_fired = row
+        if last_fired is not None and next_fire <= last_fired:
+            return None
+        if grace is not None and next_fire <= now - grace:
+            LOG.warning('Clock {} missed its time while stopped: {}'.format(key[0] or key[1], next_fire))
+            return None
+        return next_fire
+
+    def armed(self, key, name, next_fire):
+        """"""
+        self._db.execute('INSERT OR IGNORE INTO clocks (key) VALUES (?)', (_key(key),))
+        self._db.execute('UPDATE clocks SET name = ?, next_fire = ? WHERE key = ?', (name, next_fire, _key(key)))
+
+    def fired(self, key, deadline):
+        """mark the time fired, before the clock rings"""
+        self._db.execute('UPDATE clocks SET last_fired = ? WHERE key = ?', (deadline, _key(key)))
+        self.commit()
+
+    def forget(self, key):
+        """"""
+        self._db.execute('DELETE FROM clocks WHERE key = ?', (_key(key),))
+
+    def prune(self, keys, owned=None):
+        """
+        forget clocks not in keys
+        :param keys: Clock.key of the clocks kept
+        :param owned: function of a stored key, only clocks it is true for are
+            forgotten, e.g. those of the label run; None for all
+        """
+        keep = set(_key(key) for key in keys)
+        stored = [row[0] for row in self._db.execute('SELECT key FROM clocks')]
+        self._db.executemany('DELETE FROM clocks WHERE key = ?',
+                             [(k,) for k in stored if k not in keep and (owned is None or owned(json.loads(k)))])
+
+    def commit(self):
+        """"""
+        self._db.commit()
+
+    def close(self):
+        """"""
+        self._db.commit()
+        self._db.close()
+
+
+def _key(key):
     """"""
+    return json.dumps(list(key), sort_keys=True)
+
+
+class SchedClocks(object):
+    """run_clocks() of alarm.py, resuming from the job store"""
 
     @staticmethod
-    def run_clocks():
-        """"""
-        raise NotImplementedError
+    def run_clocks(run, label='all', backend='heap'):
+        """
+        :param run: run_clocks() of alarm.py, passed in as alarm.py is __main__
+        """
+        store = JobStore(STORE_FILE)
+        try:
+            run(label, store=store, backend=backend)
+        finally:
+            store.close()
 
     @staticmethod
     def is_available():
-        return False
+        return sqlite3 is not None
 
 
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    pass
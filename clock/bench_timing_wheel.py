@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+python bench_timing_wheel.py [OPTIONS]
+
+Benchmark the scheduler backends of alarm.py on a virtual clock: arm N alarms,
+most of them per-minute reminders, cancel and re-arm some, then run the
+virtual clock on for a while, second by second, re-arming every alarm after it
+fires. Nothing sleeps, so the time measured is the CPU time of the scheduler.
+The memory of the armed alarms is measured in a run of its own, by
+tracemalloc, which would slow the timed run down. A last run steps the
+virtual clock back an hour and counts the alarms fired before their deadline,
+which must be none.
+
+Options:
+--alarms N    armed alarms, defaults to 100000
+--seconds N   virtual seconds to run, defaults to 300
+--backend B   heap or wheel, repeatable, defaults to both
+--seed N      random seed, defaults to 0
+"""
+import random
+import sys
+import time
+from optparse import OptionParser
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from scheduler import HeapScheduler
+from timing_wheel import WheelScheduler
+
+BACKENDS = {'heap': HeapScheduler, 'wheel': WheelScheduler}
+# share of the alarms ringing every minute, the others ring daily
+PER_MINUTE = 0.9
+# seconds the virtual clock steps back, alarms armed around it
+JUMP_BACK = 3600
+JUMP_ALARMS = 1000
+_cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+def main():
+    """"""
+    options = parse_args(*sys.argv[1:])
+    print('{:<8}{:>10}{:>12}{:>12}{:>10}{:>12}{:>12}{:>10}{:>8}'.format(
+        'backend', 'alarms', 'arm us/op', 'cancel us', 'fired', 'run cpu s', 'us/fire', 'peak MB', 'early'))
+    for backend in options.backends or sorted(BACKENDS):
+        row = bench(BACKENDS[backend], options.alarms, options.seconds, options.seed)
+        row += (armed_memory(BACKENDS[backend], options.alarms, options.seed),
+                fired_early(BACKENDS[backend], options.seed))
+        print('{:<8}{:>10}{:>12.2f}{:>12.2f}{:>10}{:>12.3f}{:>12.2f}{:>10}{:>8}'.format(backend, *row))
+        sys.stdout.flush()
+
+
+def parse_args(*args):
+    """"""
+    parser = OptionParser(usage="\n\tpython bench_timing_wheel.py [OPTIONS]",
+                          prog="bench_timing_wheel",
+                          add_help_option=True)
+    parser.add_option('--alarms', dest='alarms', metavar='N', type='int', default=100000,
+                      help='armed alarms')
+    parser.add_option('--seconds', dest='seconds', metavar='N', type='int', default=300,
+                      help='virtual seconds to run')
+    parser.add_option('--backend', dest='backends', metavar='B', type='choice', choices=sorted(BACKENDS),
+                      action='append', default=[], help='heap or wheel, repeatable')
+    parser.add_option('--seed', dest='seed', metavar='N', type='int', default=0,
+                      help='random seed')
+    options, rest = parser.parse_args(list(args))
+    if rest:
+        parser.error('unexpected arguments: {}'.format(' '.join(rest)))
+    return options
+
+
+def bench(backend, alarms, seconds, seed=0):
+    """
+    :param backend: Scheduler class
+    :param alarms: number of alarms
+    :param seconds: virtual seconds to run
+    :param seed:
+    :return: (alarms, us per arm, us per cancel, fired, run cpu seconds, us per fire)
+    """
+    rnd = random.Random(seed)
+    start = 1500000000.0
+    now = [start]
+    scheduler = backend(clock=lambda: now[0])
+    fired = [0]
+
+    def ring(period):
+        fired[0] += 1
+        scheduler.add(now[0] + period, ring, [period])
+
+    t = _cpu_time()
+    jobs = _arm(scheduler, rnd, start, alarms, ring)
+    arm = (_cpu_time() - t) / alarms * 1e6
+
+    # a tenth of them changed, as by a reload
+    changed = rnd.sample(range(alarms), alarms // 10)
+    t = _cpu_time()
+    for i in changed:
+        scheduler.cancel(jobs[i])
+    cancel = (_cpu_time() - t) / max(len(changed), 1) * 1e6
+    for i in changed:
+        jobs[i] = scheduler.add(start + rnd.randint(1, 60), ring, [60])
+
+    t = _cpu_time()
+    for _ in range(seconds):
+        now[0] += 1
+        scheduler.run_due()
+    run = _cpu_time() - t
+    return alarms, arm, cancel, fired[0], run, run / max(fired[0], 1) * 1e6
+
+
+def armed_memory(backend, alarms, seed=0):
+    """
+    :return: MB allocated by arming the alarms, '-' without tracemalloc
+    """
+    if tracemalloc is None:
+        return '-'
+    start = 1500000000.0
+    tracemalloc.start()
+    scheduler = backend(clock=lambda: start)
+    _arm(scheduler, random.Random(seed), start, alarms, None)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del scheduler
+    return '{:.1f}'.format(peak / float(1 << 20))
+
+
+def fired_early(backend, seed=0):
+    """
+    step the virtual clock back JUMP_BACK seconds with alarms armed, arm as
+    many after the step, and run it on until all of them have fired
+    :return: number of alarms fired before their deadline
+    """
+    rnd = random.Random(seed)
+    start = 1500000000.5
+    now = [start]
+    scheduler = backend(clock=lambda: now[0])
+    early = [0]
+
+    def ring(deadline):
+        if now[0] < deadline:
+            early[0] += 1
+
+    for _ in range(JUMP_ALARMS):
+        deadline = start + rnd.uniform(1, 600)
+        scheduler.add(deadline, ring, [deadline])
+    for _ in range(300):
+        now[0] += 1
+        scheduler.run_due()
+    now[0] -= JUMP_BACK
+    for _ in range(JUMP_ALARMS):
+        deadline = now[0] + rnd.uniform(1, 600)
+        scheduler.add(deadline, ring, [deadline])
+    while len(scheduler):
+        now[0] += 1
+        scheduler.run_due()
+    return early[0]
+
+
+def _arm(scheduler, rnd, start, alarms, ring):
+    """
+    :return: [Job]
+    """
+    jobs = []
+    for _ in range(alarms):
+        period = 60 if rnd.random() < PER_MINUTE else 86400
+        jobs.append(scheduler.add(start + rnd.randint(1, period), ring, [period]))
+    return jobs
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+clock.json, validated once and indexed by label
+
+A validated snapshot is kept by the (inode, size, mtime) of the file: in
+memory for the reloads of a running process, and marshalled to CACHE_FILE for
+the next command line call, which then skips parsing and validating the json.
+"""
+import json
+import marshal
+import os
+import sys
+
+CACHE_FILE = os.path.expanduser('~/.eacon-alarm.conf.cache')
+CACHE_VERSION = 1
+
+DEFAULT_KEYS = ('default_ringtone_folder', 'default_ringtone', 'default_filter', 'default_status',
+                'default_label')
+STATUSES = ('on', 'off')
+_TEXT = (type(u''), type(''))
+_NUMBER = (int, float)
+# key: allowed types of a clock entry, a 'default_' key is checked the same
+CLOCK_KEYS = {
+    'time': _TEXT,
+    'name': _TEXT,
+    'filter': (list,),
+    'status': _TEXT,
+    'label': _TEXT,
+    'ringtone': _TEXT,
+    'ringtone_folder': _TEXT,
+    'misfire_grace': _NUMBER + (type(None),),
+}
+
+
+class ConfigError(ValueError):
+    """"""
+    pass
+
+
+class Config(object):
+    """a validated clock.json"""
+
+    def __init__(self, conf, labels, signature=None):
+        """
+        :param conf: parsed json
+        :param labels: {lower case label: [index of clock]}
+        :param signature: (inode, size, mtime) of the file
+        """
+        self.conf = conf
+        self.labels = labels
+        self.signature = signature
+
+    @classmethod
+    def parse(cls, conf, signature=None):
+        """
+        :raise ConfigError:
+        """
+        validate(conf)
+        labels = {}
+        default_label = conf['default_label']
+        for i, clock in enumerate(conf['clocks']):
+            labels.setdefault(clock.get('label', default_label).lower(), []).append(i)
+        return cls(conf, labels, signature)
+
+    @property
+    def clocks(self):
+        """"""
+        return self.conf['clocks']
+
+    def clocks_of(self, label='all'):
+        """
+        :param label: case insensitive, 'all' for every clock
+        :return: [clock entry]
+        """
+        if label.lower() == 'all':
+            return list(self.clocks)
+        return [self.clocks[i] for i in self.labels.get(label.lower(), [])]
+
+    def clocks_on(self, label='all'):
+        """clocks_of() with status on"""
+        status = self.conf['default_status']
+        return [clock for clock in self.clocks_of(label) if clock.get('status', status) == 'on']
+
+
+def validate(conf):
+    """
+    :param conf: parsed clock.json
+    :raise ConfigError: naming the first wrong entry
+    """
+    if not isinstance(conf, dict):
+        raise ConfigError('clock.json: an object is expected')
+    for key in DEFAULT_KEYS:
+        if key not in conf:
+            raise ConfigError('clock.json: {} is missing'.format(key))
+    for key, types in CLOCK_KEYS.items():
+        if 'default_' + key in conf:
+            _check(conf['default_' + key], key, types, 'clock.json: default_' + key)
+    if not isinstance(conf.get('player', ''), _TEXT):
+        raise ConfigError('clock.json: player is not a string')
+    clocks = conf.get('clocks')
+    if not isinstance(clocks, list):
+        raise ConfigError('clock.json: clocks is not a list')
+    for i, clock in enumerate(clocks):
+        where = 'clock.json: clocks[{}]'.format(i)
+        if not isinstance(clock, dict):
+            raise ConfigError('{}: an object is expected'.format(where))
+        for key, value in clock.items():
+            if key not in CLOCK_KEYS:
+                raise ConfigError('{}: unknown key {}'.format(where, key))
+            _check(value, key, CLOCK_KEYS[key], '{}.{}'.format(where, key))
+
+
+def _check(value, key, types, where):
+    """"""
+    if not isinstance(value, types) or isinstance(value, bool):
+        raise ConfigError('{}: wrong type {}'.format(where, type(value).__name__))
+    if key == 'filter' and not all(isinstance(entry, _TEXT) for entry in value):
+        raise ConfigError('{}: entries must be strings'.format(where))
+    if key == 'status' and value not in STATUSES:
+        raise ConfigError('{}: must be one of {}'.format(where, ', '.join(STATUSES)))
+
+
+_snapshots = {}
+
+
+def load_config(path, cache_file=CACHE_FILE):
+    """
+    :param path: clock.json
+    :param cache_file: None for no cache file
+    :return: Config, the same one while the file is unchanged
+    :raise ConfigError:
+    :raise OSError: if the file cannot be read
+    """
+    st = os.stat(path)
+    signature = (st.st_ino, st.st_size, st.st_mtime)
+    config = _snapshots.get(path)
+    if config is not None and config.signature == signature:
+        return config
+    header = (CACHE_VERSION, tuple(sys.version_info[:2]), os.path.abspath(path), signature)
+    config = _read_cache(cache_file, header) if cache_file else None
+    if config is None:
+        with open(path) as f:
+            try:
+                conf = json.load(f)
+            except ValueError as e:
+                raise ConfigError('clock.json: {}'.format(e))
+        config = Config.parse(conf, signature)
+        if cache_file:
+            _write_cache(cache_file, header, config)
+    _snapshots[path] = config
+    return config
+
+
+def _read_cache(cache_file, header):
+    """
+    :return: Config, None if missing, stale or unreadable
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            if marshal.load(f) != header:
+                return None
+            conf, labels = marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    return Config(conf, labels, header[-1])
+
+
+def _write_cache(cache_file, header, config):
+    """"""
+    tmp = '{}.{}'.format(cache_file, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            marshal.dump(header, f)
+            marshal.dump((config.conf, config.labels), f)
+        os.rename(tmp, cache_file)
+    except (IOError, OSError):
+        # a cache only
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Watch clock.json for alarm.py, to reload it in place
+
+The directory of the file is watched through inotify (ctypes, Linux), so an
+editor replacing the file by a rename is seen too; elsewhere the file is
+stat()ed every POLL_INTERVAL seconds. Either way the callback only runs when
+the (inode, size, mtime) of the file changed, or when poke()d.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+import select
+import sys
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+POLL_INTERVAL = 5
+# events keep coming while a file is being saved, wait a little for the rest
+SETTLE_TIME = 0.2
+
+
+def _inotify(dir_path):
+    """
+    :return: inotify fd watching dir_path
+    :raise OSError: if inotify is not available
+    """
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        raise OSError(errno.ENOSYS, 'libc not found')
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not available')
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    if not isinstance(dir_path, bytes):
+        dir_path = dir_path.encode(sys.getfilesystemencoding())
+    if libc.inotify_add_watch(fd, dir_path, WATCH_MASK) < 0:
+        e = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(e, os.strerror(e))
+    return fd
+
+
+class ConfigWatcher(object):
+    """call on_change in a daemon thread, whenever the file changes"""
+
+    def __init__(self, path, on_change, interval=POLL_INTERVAL):
+        """
+        :param path: file to watch
+        :param on_change: called without arguments
+        :param interval: seconds between polls, without inotify
+        """
+        self.path = os.path.abspath(path)
+        self.on_change = on_change
+        self.interval = interval
+        self._signature = self._stat()
+        self._poke_r, self._poke_w = os.pipe()
+        for fd in (self._poke_r, self._poke_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            self._inotify_fd = _inotify(os.path.dirname(self.path))
+        except OSError as e:
+            LOG.info('Poll {} every {}s, no inotify: {}'.format(self.path, interval, e))
+            self._inotify_fd = None
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """"""
+        self._thread = threading.Thread(target=self.run, name='config-watch')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def poke(self):
+        """
+        call on_change even if the file looks the same, safe in a signal handler
+        """
+        try:
+            os.write(self._poke_w, b'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def stop(self):
+        """"""
+        self._stopped = True
+        self.poke()
+        if self._thread:
+            self._thread.join()
+
+    def run(self):
+        """"""
+        while True:
+            poked = self._wait()
+            if self._stopped:
+                return
+            signature = self._stat()
+            if not poked and signature == self._signature:
+                continue
+            self._signature = signature
+            LOG.info('Config changed: {}'.format(self.path))
+            try:
+                self.on_change()
+            except Exception as e:
+                LOG.exception('Config reload failed: {}'.format(e))
+
+    def _wait(self):
+        """
+        :return: True if poked
+        """
+        fds = [self._poke_r]
+        if self._inotify_fd is not None:
+            fds.append(self._inotify_fd)
+        timeout = None if self._inotify_fd is not None else self.interval
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if self._inotify_fd in readable:
+            time.sleep(SETTLE_TIME)
+            self._drain(self._inotify_fd)
+        if self._poke_r in readable:
+            self._drain(self._poke_r)
+            return True
+        return False
+
+    @staticmethod
+    def _drain(fd):
+        """"""
+        while True:
+            try:
+                if not os.read(fd, 1 << 16):
+                    return
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                return
+
+    def _stat(self):
+        """(inode, size, mtime), None while the file is missing"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime
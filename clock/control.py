@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Control socket of the alarm daemon
+
+A UNIX domain socket, one request per connection: the client sends a json
+line {"cmd": ..., "args": {...}}, the daemon answers with a json line
+{"ok": true, "result": ...} or {"ok": false, "error": ...}.
+"""
+import errno
+import json
+import logging
+import os
+import socket
+import threading
+
+LOG = logging.getLogger(__name__)
+
+TIMEOUT = 2
+MAX_REQUEST = 1 << 16
+
+
+class ControlError(Exception):
+    """the daemon answered with an error"""
+    pass
+
+
+class NotRunning(ControlError):
+    """no daemon is listening"""
+    pass
+
+
+class ControlServer(object):
+    """answer requests in a daemon thread"""
+
+    def __init__(self, path, handlers, call=None):
+        """
+        :param path: socket file
+        :param handlers: {cmd: function}, called with the args of the request
+        :param call: runs a function without arguments, e.g. in another thread,
+            returns its result
+        """
+        self.path = path
+        self.handlers = handlers
+        self.call = call or (lambda func: func())
+        self._sock = None
+        self._thread = None
+        # held while a request is answered, close() waits for it
+        self._busy = threading.Lock()
+
+    def start(self):
+        """
+        :raise ControlError: if another daemon listens on the socket
+        """
+        try:
+            request(self.path, 'stats')
+        except NotRunning:
+            pass
+        else:
+            raise ControlError('Another process listens on {}'.format(self.path))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen(8)
+        self._thread = threading.Thread(target=self.run, name='control')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def run(self):
+        """"""
+        sock = self._sock
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                # closed
+                return
+            with self._busy:
+                try:
+                    conn.settimeout(TIMEOUT)
+                    self._handle(conn)
+                except Exception as e:
+                    LOG.exception('Control request failed: {}'.format(e))
+                finally:
+                    conn.close()
+
+    def _handle(self, conn):
+        """"""
+        data = _read_line(conn)
+        try:
+            req = json.loads(data.decode('utf-8'))
+            cmd = req['cmd']
+            args = dict((str(k), v) for k, v in req.get('args', {}).items())
+        except (ValueError, KeyError, TypeError, AttributeError):
+            resp = {'ok': False, 'error': 'Bad request: {!r}'.format(data[:100])}
+        else:
+            if cmd not in self.handlers:
+                resp = {'ok': False, 'error': 'Unknown request: {}'.format(cmd)}
+            else:
+                LOG.info('Control request: {} {}'.format(cmd, args))
+                handler = self.handlers[cmd]
+                try:
+                    resp = {'ok': True, 'result': self.call(lambda: handler(**args))}
+                except Exception as e:
+                    resp = {'ok': False, 'error': str(e)}
+        conn.sendall(json.dumps(resp).encode('utf-8') + b'\n')
+
+    def close(self):
+        """once the request being answered is, e.g. a shutdown"""
+        with self._busy:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+
+
+def request(path, cmd, timeout=TIMEOUT, **args):
+    """
+    :param path: socket file
+    :param cmd:
+    :param timeout: seconds
+    :param args: of the handler
+    :return: result of the handler
+    :raise NotRunning:
+    :raise ControlError:
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error as e:
+            raise NotRunning('{}: {}'.format(path, e))
+        sock.sendall(json.dumps({'cmd': cmd, 'args': args}).encode('utf-8') + b'\n')
+        resp = json.loads(_read_line(sock).decode('utf-8'))
+    finally:
+        sock.close()
+    if not resp['ok']:
+        raise ControlError(resp['error'])
+    return resp['result']
+
+
+def _read_line(sock):
+    """"""
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > MAX_REQUEST:
+            raise ControlError('Request too long')
+    return data
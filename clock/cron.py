@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""
+Filter rules of clock.json, compiled once into bitsets
+
+A filter entry is one of:
+    mon ... sun, weekday, weekend, everyday   days on which the clock time rings
+    2017-12-24, 2017-12-24..2018-01-02        dates on which the clock time rings too
+    !2017-12-25, !2018-02-15..2018-02-21      dates on which nothing rings
+    */15 9-17 * * mon-fri, @daily             cron expressions, with their own times
+
+Every field of a rule is an int used as a bitset, the next fire time is found
+by scanning bits field by field, from month down to second, instead of
+stepping through the calendar.
+"""
+import calendar
+import re
+from datetime import date, datetime, timedelta
+
+# cron convention: 0 is Sunday, 7 is accepted too
+WEEKDAY_NAMES = ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')
+MONTH_NAMES = ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+DAY_FILTERS = {
+    'mon': 1 << 1,
+    'tue': 1 << 2,
+    'wed': 1 << 3,
+    'thu': 1 << 4,
+    'fri': 1 << 5,
+    'sat': 1 << 6,
+    'sun': 1 << 0,
+    'weekday': 0b0111110,
+    'weekend': 0b1000001,
+    'everyday': 0b1111111,
+}
+MACROS = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+_DATE_RANGE = re.compile(r'^(!?)(\d{4}-\d{2}-\d{2})(?:\.\.(\d{4}-\d{2}-\d{2}))?$')
+# rules which cannot match, like Feb 30, give up after this many years
+MAX_YEARS = 8
+
+
+def _next_bit(mask, start):
+    """
+    :return: lowest set bit at or above start, None if there is none
+    """
+    m = mask >> start
+    if not m:
+        return None
+    return start + (m & -m).bit_length() - 1
+
+
+def _low_bit(mask):
+    """"""
+    return (mask & -mask).bit_length() - 1
+
+
+def _bits(lo, hi):
+    """bits lo..hi set"""
+    return ((1 << (hi + 1)) - 1) & ~((1 << lo) - 1)
+
+
+def parse_field(field, lo, hi, names=()):
+    """
+    :param field: cron field, e.g. '*', '*/15', '1-5', 'mon-fri', '0,30'
+    :param lo: lowest value
+    :param hi: highest value
+    :param names: names of values from lo on
+    :return: bitset
+    :raise ValueError:
+    """
+    mask = 0
+    for part in field.lower().split(','):
+        part, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if step < 1:
+            raise ValueError('Bad step in cron field: {}'.format(field))
+        if part == '*':
+            start, end = lo, hi
+        else:
+            start, dash, end = part.partition('-')
+            start = _value(start, lo, names)
+            end = _value(end, lo, names) if dash else (hi if step > 1 else start)
+        if not lo <= start <= hi or not lo <= end <= hi or start > end:
+            raise ValueError('Value out of range in cron field: {}'.format(field))
+        for value in range(start, end + 1, step):
+            mask |= 1 << value
+    return mask
+
+
+def _value(text, lo, names):
+    """"""
+    if text in names:
+        return lo + names.index(text)
+    if not text.isdigit():
+        raise ValueError('Bad value in cron field: {}'.format(text))
+    return int(text)
+
+
+class CronRule(object):
+    """second, minute, hour, day of month, month and weekday bitsets"""
+
+    __slots__ = ('seconds', 'minutes', 'hours', 'days', 'months', 'weekdays', 'any_day', 'any_weekday')
+
+    def __init__(self, seconds, minutes, hours, days, months, weekdays, any_day=True, any_weekday=True):
+        self.seconds = seconds
+        self.minutes = minutes
+        self.hours = hours
+        self.days = days
+        self.months = months
+        self.weekdays = weekdays
+        # cron: with a '*' day or weekday field a day has to match both, otherwise either
+        self.any_day = any_day
+        self.any_weekday = any_weekday
+
+    @classmethod
+    def parse(cls, expression):
+        """
+        :param expression: 'minute hour day month weekday', or a macro like '@daily'
+        :return: CronRule
+        :raise ValueError:
+        """
+        fields = MACROS.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError('Cron expression needs 5 fields: {}'.format(expression))
+        minute, hour, day, month, weekday = fields
+        weekdays = parse_field(weekday, 0, 7, WEEKDAY_NAMES)
+        if weekdays & (1 << 7):
+            weekdays = (weekdays | 1) & ~(1 << 7)
+        return cls(1, parse_field(minute, 0, 59), parse_field(hour, 0, 23), parse_field(day, 1, 31),
+                   parse_field(month, 1, 12, MONTH_NAMES), weekdays,
+                   any_day=day.startswith('*'), any_weekday=weekday.startswith('*'))
+
+    @classmethod
+    def daily(cls, seconds_of_day, weekdays):
+        """the clock time on the weekdays of a bitset"""
+        h, rest = divmod(seconds_of_day, 3600)
+        m, s = divmod(rest, 60)
+        return cls(1 << s, 1 << m, 1 << h, _bits(1, 31), _bits(1, 12), weekdays, any_weekday=weekdays == 0b1111111)
+
+    def next_after(self, dt):
+        """
+        :param dt: naive local datetime
+        :return: first matching datetime later than dt, None if there is none
+        """
+        t = dt.replace(microsecond=0) + timedelta(seconds=1)
+        last_year = t.year + MAX_YEARS
+        while t.year <= last_year:
+            month = _next_bit(self.months, t.month)
+            if month is None:
+                t = datetime(t.year + 1, _low_bit(self.months), 1)
+                continue
+            if month != t.month:
+                t = datetime(t.year, month, 1)
+            day = self._next_day(t.year, t.month, t.day)
+            if day is None:
+                t = self._next_month(t)
+                continue
+            if day != t.day:
+                t = datetime(t.year, t.month, day)
+            hour = _next_bit(self.hours, t.hour)
+            if hour is None:
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0, second=0)
+            minute = _next_bit(self.minutes, t.minute)
+            if minute is None:
+                t = t.replace(minute=0, second=0) + timedelta(hours=1)
+                continue
+            if minute != t.minute:
+                t = t.replace(minute=minute, second=0)
+            second = _next_bit(self.seconds, t.second)
+            if second is None:
+                t = t.replace(second=0) + timedelta(minutes=1)
+                continue
+            return t.replace(second=second)
+        return None
+
+    def _next_day(self, year, month, day):
+        """
+        :return: first matching day of month at or after day, None if none is left in the month
+        """
+        month_days = calendar.monthrange(year, month)[1]
+        days = self.days & _bits(1, month_days)
+        if self.any_day or self.any_weekday:
+            # both fields have to match, a '*' one matches anyway
+            d = _next_bit(days, day)
+            while d is not None and not self._weekday_matches(year, month, d):
+                d = _next_bit(days, d + 1)
+            return d
+        # two restricted fields, either one has to match
+        by_day = _next_bit(days, day)
+        wday = self._weekday(year, month, day)
+        ahead = _next_bit(self.weekdays, wday)
+        ahead = ahead - wday if ahead is not None else 7 - wday + _low_bit(self.weekdays)
+        by_weekday = day + ahead if day + ahead <= month_days else None
+        candidates = [d for d in (by_day, by_weekday) if d is not None]
+        return min(candidates) if candidates else None
+
+    def _weekday_matches(self, year, month, day):
+        """"""
+        return self.weekdays >> self._weekday(year, month, day) & 1
+
+    @staticmethod
+    def _weekday(year, month, day):
+        """cron convention, 0 for Sunday"""
+        return (date(year, month, day).weekday() + 1) % 7
+
+    @staticmethod
+    def _next_month(t):
+        """"""
+        if t.month == 12:
+            return datetime(t.year + 1, 1, 1)
+        return datetime(t.year, t.month + 1, 1)
+
+
+class Schedule(object):
+    """the compiled filter of a clock"""
+
+    __slots__ = ('rules', 'seconds_of_day', 'dates', 'excludes')
+
+    def __init__(self, rules=(), seconds_of_day=None, dates=(), excludes=()):
+        """
+        :param rules: CronRule
+        :param seconds_of_day: clock time, rings on the dates too
+        :param dates: [(first date, last date)]
+        :param excludes: [(first date, last date)], nothing rings on them
+        """
+        self.rules = list(rules)
+        self.seconds_of_day = seconds_of_day
+        self.dates = list(dates)
+        self.excludes = list(excludes)
+
+    def next_fire(self, dt):
+        """
+        :param dt: naive local datetime
+        :return: first fire time later than dt, None if there is none
+        """
+        while True:
+            candidates = [t for t in (rule.next_after(dt) for rule in self.rules) if t is not None]
+            t = self._next_date(dt)
+            if t is not None:
+                candidates.append(t)
+            if not candidates:
+                return None
+            t = min(candidates)
+            excluded = [last for first, last in self.excludes if first <= t.date() <= last]
+            if not excluded:
+                return t
+            # go on from the last second of the excluded days
+            dt = datetime.combine(max(excluded), datetime.min.time()) + timedelta(days=1, seconds=-1)
+
+    def _next_date(self, dt):
+        """clock time on the dates"""
+        if self.seconds_of_day is None:
+            return None
+        clock_time = timedelta(seconds=self.seconds_of_day)
+        best = None
+        for first, last in self.dates:
+            day = max(first, dt.date())
+            t = datetime.combine(day, datetime.min.time()) + clock_time
+            if t <= dt:
+                t += timedelta(days=1)
+            if t.date() <= last and (best is None or t < best):
+                best = t
+        return best
+
+
+def compile_filter(filters, seconds_of_day=None):
+    """
+    :param filters: entries of the filter list
+    :param seconds_of_day: clock time, None for clocks of cron expressions only
+    :return: Schedule
+    :raise ValueError: for unknown entries, or days and dates without a time
+    """
+    weekdays = 0
+    rules, dates, excludes = [], [], []
+    for entry in filters:
+        key = entry.strip().lower()
+        if key in DAY_FILTERS:
+            weekdays |= DAY_FILTERS[key]
+            continue
+        m = _DATE_RANGE.match(key)
+        if m:
+            exclude, first, last = m.groups()
+            first = datetime.strptime(first, '%Y-%m-%d').date()
+            last = datetime.strptime(last, '%Y-%m-%d').date() if last else first
+            (excludes if exclude else dates).append((first, last))
+            continue
+        if len(key.split()) == 1 and key not in MACROS:
+            raise ValueError('Unknown filter: {}'.format(entry))
+        rules.append(CronRule.parse(entry))
+    if seconds_of_day is None:
+        if weekdays or dates:
+            raise ValueError('Filter needs a time: {}'.format(', '.join(filters)))
+    elif weekdays:
+        rules.append(CronRule.daily(seconds_of_day, weekdays))
+    return Schedule(rules, seconds_of_day, dates, excludes)
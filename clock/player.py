@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Ringtone players of alarm.py
+
+A player is a child process started without a shell; its pid is kept, so
+stopping the music only stops what this process started.
+"""
+import logging
+import os
+import subprocess
+import time
+
+LOG = logging.getLogger(__name__)
+
+# backend: command, the file to play is appended; null plays nothing
+BACKENDS = {
+    'afplay': ['afplay'],
+    'paplay': ['paplay'],
+    'aplay': ['aplay', '-q'],
+    'null': None,
+}
+# tried in this order by 'auto'
+AUTO_ORDER = ('afplay', 'paplay', 'aplay')
+# seconds between SIGTERM and SIGKILL, players exit on SIGTERM at once; well
+# within the second a control request of alarm.py is answered in
+STOP_TIMEOUT = 0.2
+
+
+def which(program):
+    """
+    :return: full path of program on PATH, None if not found
+    """
+    for dir_path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(dir_path, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def find_backend(name='auto'):
+    """
+    :param name: one of BACKENDS, or 'auto' for the first one installed
+    :return: backend name
+    :raise ValueError:
+    """
+    if name == 'auto':
+        for backend in AUTO_ORDER:
+            if which(BACKENDS[backend][0]):
+                return backend
+        LOG.warning('No player found of: {}, nothing will be heard'.format(', '.join(AUTO_ORDER)))
+        return 'null'
+    if name not in BACKENDS:
+        raise ValueError('Unknown player: {}, choose from: auto, {}'.format(name, ', '.join(sorted(BACKENDS))))
+    return name
+
+
+class Player(object):
+    """plays files by a backend, tracks the processes it started"""
+
+    def __init__(self, backend='auto'):
+        self.backend = find_backend(backend)
+        # of the null backend, which may run for ever: a count, not a list
+        self.plays = 0
+        self.last_played = None
+        self._procs = {}  # pid -> Popen
+
+    def use(self, backend):
+        """switch to backend, what is playing is stopped if it changes"""
+        backend = find_backend(backend)
+        if backend != self.backend:
+            self.stop()
+            self.backend = backend
+
+    def play(self, path):
+        """
+        start playing, returns at once
+        :return: pid, None for the null backend
+        """
+        self._reap()
+        command = BACKENDS[self.backend]
+        if command is None:
+            self.plays += 1
+            self.last_played = path
+            return None
+        with open(os.devnull, 'r+b') as null:
+            proc = subprocess.Popen(command + [path], stdin=null, stdout=null, stderr=null, close_fds=True)
+        self._procs[proc.pid] = proc
+        LOG.info('Player {} pid {} is playing: {}'.format(self.backend, proc.pid, path))
+        return proc.pid
+
+    def playing(self):
+        """pids still playing"""
+        self._reap()
+        return sorted(self._procs)
+
+    def stop(self):
+        """
+        terminate the processes started here, kill those which do not exit
+        :return: number stopped
+        """
+        procs = [proc for proc in self._procs.values() if proc.poll() is None]
+        for proc in procs:
+            _signal(proc, 'terminate')
+        deadline = time.time() + STOP_TIMEOUT
+        for proc in procs:
+            while proc.poll() is None and time.time() < deadline:
+                time.sleep(0.02)
+            if proc.poll() is None:
+                _signal(proc, 'kill')
+                proc.wait()
+        self._procs.clear()
+        LOG.info('Stopped {} player(s)'.format(len(procs)))
+        return len(procs)
+
+    def _reap(self):
+        """forget processes which exited, so they are no zombies"""
+        for pid, proc in list(self._procs.items()):
+            if proc.poll() is not None:
+                del self._procs[pid]
+
+
+def _signal(proc, method):
+    """"""
+    try:
+        getattr(proc, method)()
+    except OSError:
+        # exited meanwhile
+        pass
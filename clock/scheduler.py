@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+Single-thread scheduler for alarm.py
+
+All clocks share one thread, driven by a min-heap of deadlines (or a timing
+wheel, see timing_wheel.py). The thread sleeps in select() until the earliest
+deadline; adding an earlier job wakes it through a pipe, so nothing polls.
+
+Deadlines are wall clock times, while select() sleeps on the monotonic clock,
+which stands still in suspend. So a sleep is cut to MAX_SLEEP and deadlines
+are checked against the wall clock again on every wake; a job found later than
+its grace window is a misfire and is not run.
+"""
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import select
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# longest sleep before the wall clock is checked again
+MAX_SLEEP = 60
+# wall clock moving this many seconds more or less than the monotonic clock
+# in a sleep is reported as a jump: suspend, NTP step, manual change
+JUMP_TOLERANCE = 2
+# None on python 2, see _sleep()
+_monotonic = getattr(time, 'monotonic', None)
+
+
+class Job(object):
+    """a function call armed for a deadline"""
+
+    __slots__ = ('deadline', 'func', 'args', 'name', 'grace', 'on_misfire', 'timed', 'armed', 'slot')
+
+    def __init__(self, deadline, func, args=(), name=None, grace=None, on_misfire=None, timed=False):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.name = name
+        # seconds late it still runs, None for any
+        self.grace = grace
+        # called with args instead of func, when later than grace
+        self.on_misfire = on_misfire
+        # counted in the accuracy stats, unlike control requests and reloads
+        self.timed = timed
+        self.armed = True
+        # where a backend keeps it
+        self.slot = None
+
+
+class Scheduler(object):
+    """
+    the thread, wake up, firing and stats; a backend keeps the armed jobs by
+    _push(), _remove() and _pop_due()
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        :param clock: returns unix time, a virtual one for benchmarks
+        """
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._armed = 0
+        self._stopped = False
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # accuracy: lateness of the jobs run, in seconds
+        self._fired = 0
+        self._late_sum = 0.0
+        self._late_max = 0.0
+        self._misfires = 0
+        self._jumps = 0
+
+    def add(self, deadline, func, args=(), name=None, grace=None, on_misfire=None, timed=False):
+        """
+        :param deadline: unix time
+        :param func: called in the scheduler thread
+        :param args:
+        :param name: for logging
+        :param grace: seconds late the job still runs, None for any
+        :param on_misfire: called with args instead of func, when later than grace
+        :param timed: its lateness goes into stats(), for the clocks
+        :return: Job, for cancel()
+        """
+        job = Job(deadline, func, args, name, grace, on_misfire, timed)
+        with self._lock:
+            earliest = self._push(job)
+            self._armed += 1
+        if earliest:
+            self._wake()
+        return job
+
+    def cancel(self, job):
+        """"""
+        with self._lock:
+            if not job.armed:
+                return
+            job.armed = False
+            self._armed -= 1
+            self._remove(job)
+        self._wake()
+
+    def call(self, func, args=(), timeout=None):
+        """
+        run func in the scheduler thread as soon as possible, from another thread
+        :return: its result
+        :raise: its exception, RuntimeError on timeout
+        """
+        done = threading.Event()
+        outcome = {}
+
+        def run():
+            try:
+                outcome['result'] = func(*args)
+            except Exception as e:
+                outcome['error'] = e
+            finally:
+                done.set()
+
+        self.add(self.clock(), run, name=getattr(func, '__name__', None))
+        if not done.wait(timeout):
+            raise RuntimeError('Scheduler did not run {} in time'.format(func))
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def __len__(self):
+        return self._armed
+
+    def stats(self):
+        """
+        :return: {'fired', 'misfires', 'late_mean', 'late_max', 'clock_jumps'},
+            lateness in seconds of the timed jobs run
+        """
+        return {
+            'fired': self._fired,
+            'misfires': self._misfires,
+            'late_mean': self._late_sum / self._fired if self._fired else 0.0,
+            'late_max': self._late_max,
+            'clock_jumps': self._jumps,
+        }
+
+    def stop(self):
+        """"""
+        self._stopped = True
+        self._wake()
+
+    def run(self):
+        """fire jobs as their deadlines pass, until stop()"""
+        while not self._stopped:
+            timeout = self.run_due()
+            if self._stopped:
+                return
+            self._sleep(timeout)
+
+    def run_due(self):
+        """
+        fire the jobs due now
+        :return: seconds to the next deadline, None if no job is armed
+        """
+        while True:
+            with self._lock:
+                job, timeout = self._pop_due()
+            if job is None:
+                return timeout
+            self._fire(job)
+
+    def _push(self, job):
+        """
+        :return: True if it is the earliest job now
+        """
+        raise NotImplementedError
+
+    def _remove(self, job):
+        """job is cancelled, armed is False already"""
+        raise NotImplementedError
+
+    def _pop_due(self):
+        """
+        take the job out, disarmed
+        :return: (job due now, None), or (None, seconds to the earliest
+            deadline, None if no job is armed)
+        """
+        raise NotImplementedError
+
+    def _fire(self, job):
+        """"""
+        late = max(self.clock() - job.deadline, 0.0)
+        func = job.func
+        if job.grace is not None and late > job.grace:
+            LOG.warning('Job {} misfired, {:.0f}s late, grace {}s'.format(job.name, late, job.grace))
+            self._misfires += 1
+            func = job.on_misfire
+            if func is None:
+                return
+        else:
+            LOG.info('Fire job: {}, {:.3f}s late'.format(job.name, late))
+            if job.timed:
+                self._fired += 1
+                self._late_sum += late
+                self._late_max = max(self._late_max, late)
+        try:
+            func(*job.args)
+        except Exception as e:
+            LOG.exception('Job {} failed: {}'.format(job.name, e))
+
+    def _sleep(self, timeout):
+        """until timeout (seconds, None for ever), MAX_SLEEP or a wake up"""
+        timeout = MAX_SLEEP if timeout is None else min(timeout, MAX_SLEEP)
+        wall = time.time()
+        mono = _monotonic() if _monotonic else None
+        interrupted = False
+        try:
+            readable, _, _ = select.select([self._wake_r], [], [], timeout)
+        except (select.error, OSError) as e:
+            # python 2 does not retry on a signal
+            if e.args[0] != errno.EINTR:
+                raise
+            readable, interrupted = [], True
+        if mono is not None:
+            slept = _monotonic() - mono
+        elif not readable and not interrupted:
+            # no monotonic clock on python 2, but select() slept the whole
+            # timeout, measured by the kernel on it
+            slept = timeout
+        else:
+            slept = None
+        drift = time.time() - wall - slept if slept is not None else 0.0
+        if abs(drift) > JUMP_TOLERANCE:
+            LOG.warning('Wall clock jumped {:+.0f}s while sleeping'.format(drift))
+            self._jumps += 1
+        if readable:
+            try:
+                os.read(self._wake_r, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def _wake(self):
+        """"""
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError as e:
+            # a full pipe wakes the thread anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+class HeapScheduler(Scheduler):
+    """
+    min-heap of (deadline, seq, job), cancelled jobs are dropped when they
+    reach the top
+    """
+
+    def __init__(self, clock=time.time):
+        super(HeapScheduler, self).__init__(clock)
+        self._heap = []
+        self._seq = itertools.count()
+
+    def _push(self, job):
+        """"""
+        earliest = not self._heap or job.deadline < self._heap[0][0]
+        heapq.heappush(self._heap, (job.deadline, next(self._seq), job))
+        return earliest
+
+    def _remove(self, job):
+        """"""
+        # drop the dead entries once they are the majority
+        if len(self._heap) > 2 * self._armed + 64:
+            self._heap = [entry for entry in self._heap if entry[2].armed]
+            heapq.heapify(self._heap)
+
+    def _pop_due(self):
+        """"""
+        heap = self._heap
+        while heap and not heap[0][2].armed:
+            heapq.heappop(heap)
+        if not heap:
+            return None, None
+        timeout = heap[0][0] - self.clock()
+        if timeout > 0:
+            return None, timeout
+        job = heapq.heappop(heap)[2]
+        job.armed = False
+        self._armed -= 1
+        return job, None
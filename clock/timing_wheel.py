@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Hierarchical timing wheel backend of scheduler.py, for very many clocks
+
+Time is cut into ticks of TICK seconds. The lowest wheel has a slot per tick,
+each higher wheel a slot per turn of the wheel below it. A job goes into the
+lowest wheel whose span covers its deadline, as the wheels turn the jobs of a
+higher slot are handed down (cascaded), so inserting and cancelling a job is
+O(1) whatever the number of armed jobs. A job fires at most a tick late, never
+early: it is ready only once its deadline has passed, and when the wall clock
+steps back the wheels are started again at the new time, see rewind().
+"""
+import logging
+import math
+import time
+from collections import deque
+
+from scheduler import Scheduler
+
+LOG = logging.getLogger(__name__)
+
+TICK = 1.0
+# (bits of slot number, bits of slot width) of the wheels, lowest first:
+# 256 seconds, 4.5 hours, 12 days, 2 years, 136 years
+WHEELS = ((8, 0), (6, 8), (6, 14), (6, 20), (6, 26))
+_MAX_DELTA = 1 << (WHEELS[-1][0] + WHEELS[-1][1])
+_MASKS = [(1 << bits) - 1 for bits, _ in WHEELS]
+# wheel of a job by the bit length of its ticks ahead
+_LEVEL_OF_BITS = [min(level for level, (bits, shift) in enumerate(WHEELS) if n <= bits + shift)
+                  for n in range(WHEELS[-1][0] + WHEELS[-1][1] + 1)]
+
+
+class TimingWheel(object):
+    """jobs by deadline tick, see advance()"""
+
+    def __init__(self, now, tick=TICK):
+        """
+        :param now: unix time the wheels start at
+        :param tick: seconds
+        """
+        self.tick = tick
+        self.current = int(math.floor(now / tick))
+        self.wheels = [[set() for _ in range(1 << bits)] for bits, _ in WHEELS]
+        self.counts = [0] * len(WHEELS)
+        # due already when added
+        self.ready = deque()
+
+    def add(self, job, now=None):
+        """
+        :param job:
+        :param now: unix time, a job due by then is ready at once instead of
+            at the next tick
+        """
+        if now is not None and job.deadline <= now:
+            job.slot = (None, self.ready)
+            self.ready.append(job)
+            return
+        deadline_tick = int(math.ceil(job.deadline / self.tick))
+        delta = deadline_tick - self.current
+        if delta <= 0:
+            # not due, the wall clock is behind the current tick: the next one
+            deadline_tick = self.current + 1
+            delta = 1
+        elif delta >= _MAX_DELTA:
+            # cascaded down again as the top wheel turns
+            deadline_tick = self.current + _MAX_DELTA - 1
+            delta = _MAX_DELTA - 1
+        level = _LEVEL_OF_BITS[delta.bit_length()]
+        slot = self.wheels[level][(deadline_tick >> WHEELS[level][1]) & _MASKS[level]]
+        slot.add(job)
+        job.slot = (level, slot)
+        self.counts[level] += 1
+
+    def remove(self, job):
+        """"""
+        if job.slot is None:
+            return
+        (level, slot), job.slot = job.slot, None
+        if level is None:
+            # in ready, dropped when it comes out disarmed
+            return
+        slot.discard(job)
+        self.counts[level] -= 1
+
+    def advance(self, now):
+        """
+        turn the wheels up to now
+        :return: [job], due, in no particular order
+        """
+        due = list(self.ready)
+        self.ready.clear()
+        target = int(math.floor(now / self.tick))
+        while self.current < target:
+            self.current = self._next_event(target)
+            self._turn(self.current, now, due)
+        # cascaded onto the current tick
+        due.extend(self.ready)
+        self.ready.clear()
+        return due
+
+    def rewind(self, now, jobs=()):
+        """
+        start the wheels again at now, for the wall clock stepped back behind
+        the current tick, the armed jobs are added again
+        :param jobs: taken out already, to be added again
+        """
+        armed = [job for job in self.ready if job.slot is not None]
+        armed.extend(jobs)
+        self.ready.clear()
+        for wheel in self.wheels:
+            for slot in wheel:
+                armed.extend(slot)
+                slot.clear()
+        self.counts = [0] * len(WHEELS)
+        self.current = int(math.floor(now / self.tick))
+        for job in armed:
+            self.add(job, now)
+
+    def next_deadline(self):
+        """
+        unix time the wheels have to be advanced at next, not always a
+        deadline; None if nothing is armed
+        """
+        if self.ready:
+            return self.current * self.tick
+        if not any(self.counts):
+            return None
+        return self._next_event(None) * self.tick
+
+    def _next_event(self, target):
+        """first tick after current a slot is due or cascaded, at most target"""
+        if self.counts[0]:
+            return self.current + 1
+        best = target
+        for level in range(1, len(WHEELS)):
+            if self.counts[level]:
+                shift = WHEELS[level][1]
+                boundary = ((self.current >> shift) + 1) << shift
+                if best is None or boundary < best:
+                    best = boundary
+                # a higher wheel turns later than this one
+                break
+        return best if best is not None else self.current + 1
+
+    def _turn(self, current, now, due):
+        """cascade the slots of the higher wheels due at current, then take the lowest slot"""
+        for level in range(len(WHEELS) - 1, 0, -1):
+            bits, shift = WHEELS[level]
+            if current & ((1 << shift) - 1):
+                continue
+            slot = self.wheels[level][(current >> shift) & _MASKS[level]]
+            if not slot:
+                continue
+            jobs = list(slot)
+            slot.clear()
+            self.counts[level] -= len(jobs)
+            for job in jobs:
+                self.add(job, now)
+        slot = self.wheels[0][current & _MASKS[0]]
+        if slot:
+            self.counts[0] -= len(slot)
+            for job in slot:
+                job.slot = None
+            due.extend(slot)
+            slot.clear()
+
+
+class WheelScheduler(Scheduler):
+    """Scheduler backed by a TimingWheel, jobs due in the same tick fire by deadline"""
+
+    def __init__(self, clock=time.time, tick=TICK):
+        super(WheelScheduler, self).__init__(clock)
+        self._wheel = TimingWheel(self.clock(), tick)
+        self._due = []
+        # when the thread is going to wake up, None for never
+        self._wake_at = None
+
+    def _push(self, job):
+        """"""
+        now = self.clock()
+        self._rewind(now)
+        self._wheel.add(job, now)
+        if self._wake_at is None or job.deadline < self._wake_at:
+            # the thread wakes up and sets it again
+            self._wake_at = job.deadline
+            return True
+        return False
+
+    def _remove(self, job):
+        """"""
+        self._wheel.remove(job)
+
+    def _rewind(self, now):
+        """start the wheel again if the wall clock stepped back more than a tick"""
+        wheel = self._wheel
+        if now >= (wheel.current - 1) * wheel.tick:
+            return
+        LOG.info('Wall clock is {:.0f}s behind the timing wheel, rewinding'.format(
+            wheel.current * wheel.tick - now))
+        # taken out of the wheel due at the old time
+        wheel.rewind(now, [job for job in self._due if job.armed])
+        self._due = []
+        self._wake_at = None
+
+    def _pop_due(self):
+        """"""
+        now = self.clock()
+        self._rewind(now)
+        if not self._due:
+            due = [job for job in self._wheel.advance(now) if job.armed]
+            # popped from the end
+            due.sort(key=lambda job: job.deadline, reverse=True)
+            self._due = due
+        while self._due:
+            job = self._due.pop()
+            if job.armed:
+                job.armed = False
+                job.slot = None
+                self._armed -= 1
+                return job, None
+        self._wake_at = self._wheel.next_deadline()
+        if self._wake_at is None:
+            return None, None
+        return None, max(self._wake_at - self.clock(), 0.0)
@@ -0,0 +1,121 @@
+"""
+Read members of tar and zip archives in place, without extracting
+
+Zip members and those of an uncompressed tar can be reached directly, so they
+are listed once and read by any number of readers. A compressed tar is one
+stream, its members are read in order as it is decompressed.
+"""
+import os
+import tarfile
+import zipfile
+
+READ_SIZE = 1 << 16
+
+
+class ArchiveError(Exception):
+    """"""
+    pass
+
+
+def is_archive(path):
+    """tar (plain, gz, bz2, xz) or zip, by content"""
+    if not os.path.isfile(path):
+        return False
+    try:
+        return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+    except OSError:
+        return False
+
+
+def list_members(path):
+    """
+    regular files of an archive allowing random access
+    :param path:
+    :return: [(member name, ref)], ref is passed to ArchiveReader.members();
+        None for a compressed tar, see stream_members()
+    """
+    try:
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as zf:
+                return [(_member_name(info.filename), info.filename) for info in zf.infolist()
+                        if not info.is_dir() and not _zip_symlink(info)]
+        try:
+            tf = tarfile.open(path, 'r:')
+        except tarfile.ReadError:
+            return None
+        with tf:
+            return [(_member_name(info.name), (info.offset_data, info.size)) for info in tf if info.isreg()]
+    except (OSError, zipfile.BadZipfile, tarfile.TarError) as e:
+        raise ArchiveError('{}: {}'.format(path, e))
+
+
+def stream_members(path):
+    """
+    regular files of a (compressed) tar, in archive order
+    :return: (member name, chunks), chunks of a member must be consumed before
+        the next one is yielded
+    """
+    try:
+        with tarfile.open(path, 'r|*') as tf:
+            for info in tf:
+                if not info.isreg():
+                    continue
+                f = tf.extractfile(info)
+                yield _member_name(info.name), iter(lambda: f.read(READ_SIZE), b'')
+    except (OSError, EOFError, tarfile.TarError) as e:
+        raise ArchiveError('{}: {}'.format(path, e))
+
+
+def _member_name(name):
+    """relative '/' separated path, without leading './' of `tar c .`"""
+    while name.startswith(('./', '/')):
+        name = name[2:] if name.startswith('./') else name[1:]
+    return name
+
+
+def _zip_symlink(info):
+    """"""
+    # unix mode in the high bits of external_attr
+    return (info.external_attr >> 16) & 0o170000 == 0o120000
+
+
+class ArchiveReader(object):
+    """an open zip or plain tar, for members listed by list_members()"""
+
+    def __init__(self, path):
+        self.path = path
+        if zipfile.is_zipfile(path):
+            self._zip = zipfile.ZipFile(path)
+            self._file = None
+        else:
+            self._zip = None
+            self._file = open(path, 'rb')
+
+    def members(self, refs):
+        """
+        :param refs: from list_members()
+        :return: (ref, chunks), chunks of a member must be consumed before the next one is yielded
+        """
+        for ref in refs:
+            if self._zip is not None:
+                with self._zip.open(ref) as f:
+                    yield ref, iter(lambda: f.read(READ_SIZE), b'')
+            else:
+                yield ref, self._read(*ref)
+
+    def _read(self, offset, size):
+        """"""
+        self._file.seek(offset)
+        while size > 0:
+            chunk = self._file.read(min(size, READ_SIZE))
+            if not chunk:
+                raise ArchiveError('{}: unexpected end of archive'.format(self.path))
+            size -= len(chunk)
+            yield chunk
+
+    def close(self):
+        """"""
+        if self._zip is not None:
+            self._zip.close()
+        else:
+            self._file.close()
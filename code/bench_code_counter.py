@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+python bench_code_counter.py [OPTIONS]
+
+Benchmark code_counter.py on synthetic trees. The trees are generated from a
+seed, so a run is reproducible and two versions can be compared on the same
+input. Every profile is timed by the shell pipeline and by the in-process
+walker at several worker counts; timings are the best of --repeat runs on a
+warm page cache. files/s and MB/s are of the files each method reads: the
+walker does not read what it prunes.
+
+Profiles:
+small     many small files over a few levels
+huge      a few huge files
+deep      files spread over deeply nested directories
+ignored   most files under directories listed in .gitignore, the walker prunes
+          them while the shell pipeline still reads them
+
+Options:
+--dir DIR     where the trees are generated, defaults to a temporary directory
+--scale F     multiply file counts and sizes by F, defaults to 1
+--seed N      random seed, defaults to 0
+--workers N,N worker counts of the walker, defaults to 1,2,4 and cpu count
+--repeat N    runs per measurement, the fastest is reported, defaults to 3
+--profile P   run only profile P, repeatable
+--keep        keep the generated trees
+"""
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from code_counter import walk_dir, shell_pipeline
+from languages import LANGUAGES
+
+PROFILES = ('small', 'huge', 'deep', 'ignored')
+LANGUAGE = 'python'
+
+_WORDS = ('value', 'count', 'index', 'result', 'items', 'path', 'name', 'total', 'data', 'node')
+_COMMENTS = ('# TODO: handle the empty case', '# keep the order stable', '# see the caller')
+
+
+def main():
+    """"""
+    options = parse_args(*sys.argv[1:])
+    root = options.dir or tempfile.mkdtemp(prefix='bench_code_counter.')
+    profiles = options.profiles or PROFILES
+    print('{:<10}{:<10}{:>8}{:>10}{:>12}{:>10}{:>10}'.format(
+        'profile', 'method', 'workers', 'seconds', 'files/s', 'MB/s', 'code'))
+    try:
+        for profile in profiles:
+            tree = os.path.join(root, profile)
+            if os.path.exists(tree):
+                shutil.rmtree(tree)
+            make_tree(tree, profile, options.scale, options.seed)
+            for row in bench_tree(tree, options.workers, options.repeat):
+                print('{:<10}{:<10}{:>8}{:>10.3f}{:>12.0f}{:>10.1f}{:>10}'.format(profile, *row))
+                sys.stdout.flush()
+    finally:
+        if not options.keep and not options.dir:
+            shutil.rmtree(root)
+
+
+def parse_args(*args):
+    """"""
+    parser = OptionParser(usage="\n\tpython bench_code_counter.py [OPTIONS]",
+                          prog="bench_code_counter",
+                          add_help_option=True)
+    parser.add_option('--dir', dest='dir', metavar='DIR', default=None,
+                      help='where the trees are generated, defaults to a temporary directory')
+    parser.add_option('--scale', dest='scale', metavar='F', type='float', default=1.0,
+                      help='multiply file counts and sizes by F')
+    parser.add_option('--seed', dest='seed', metavar='N', type='int', default=0,
+                      help='random seed')
+    parser.add_option('--workers', dest='workers', metavar='N,N', default=None,
+                      help='worker counts of the walker, defaults to 1,2,4 and cpu count')
+    parser.add_option('--repeat', dest='repeat', metavar='N', type='int', default=3,
+                      help='runs per measurement, the fastest is reported')
+    parser.add_option('--profile', dest='profiles', metavar='P', type='choice', choices=list(PROFILES),
+                      action='append', default=[], help='run only profile P, repeatable')
+    parser.add_option('--keep', dest='keep', action='store_true', default=False,
+                      help='keep the generated trees')
+    options, rest = parser.parse_args(list(args))
+    if rest:
+        parser.error('unexpected arguments: {}'.format(' '.join(rest)))
+    if options.workers:
+        options.workers = [int(w) for w in options.workers.split(',')]
+    else:
+        options.workers = sorted({1, 2, 4, os.cpu_count() or 1})
+    return options
+
+
+def make_tree(tree, profile, scale=1.0, seed=0):
+    """
+    generate the tree of a profile, the same for the same arguments
+    :param tree: directory to create
+    :param profile: one of PROFILES
+    :param scale:
+    :param seed:
+    :return:
+    """
+    rnd = random.Random('{}:{}'.format(seed, profile))
+
+    def n(count):
+        return max(1, int(count * scale))
+
+    if profile == 'small':
+        for i in range(n(20000)):
+            _write(os.path.join(tree, 'pkg{:02d}'.format(i % 50), 'sub{}'.format(i % 7), 'm{}.py'.format(i)),
+                   rnd, rnd.randint(5, 120))
+    elif profile == 'huge':
+        for i in range(4):
+            _write(os.path.join(tree, 'huge{}.py'.format(i)), rnd, n(1000000))
+    elif profile == 'deep':
+        for i in range(n(4000)):
+            depth = rnd.randint(10, 40)
+            parts = ['d{}'.format(rnd.randint(0, 2)) for _ in range(depth)]
+            _write(os.path.join(tree, *(parts + ['m{}.py'.format(i)])), rnd, rnd.randint(5, 120))
+    elif profile == 'ignored':
+        os.makedirs(tree)
+        with open(os.path.join(tree, '.gitignore'), 'w') as f:
+            f.write('build/\nnode_modules/\n*.pyc\n')
+        for i in range(n(2000)):
+            _write(os.path.join(tree, 'src', 'm{}.py'.format(i)), rnd, rnd.randint(5, 120))
+        for i in range(n(16000)):
+            top = 'build' if i % 2 else 'node_modules'
+            _write(os.path.join(tree, top, 'p{}'.format(i % 100), 'm{}.py'.format(i)), rnd,
+                   rnd.randint(5, 120))
+    else:
+        raise ValueError('Unknown profile: {}'.format(profile))
+
+
+def _write(path, rnd, lines):
+    """a python-like file of lines, with blank and comment lines"""
+    dir_path = os.path.dirname(path)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    out = []
+    for _ in range(lines):
+        r = rnd.random()
+        if r < 0.15:
+            out.append('')
+        elif r < 0.25:
+            out.append(rnd.choice(_COMMENTS))
+        else:
+            out.append('    ' * rnd.randint(0, 3) + '{} = {}({}) + {}'.format(
+                rnd.choice(_WORDS), rnd.choice(_WORDS), rnd.choice(_WORDS), rnd.randint(0, 1000)))
+    with open(path, 'w') as f:
+        f.write('\n'.join(out))
+        f.write('\n')
+
+
+def bench_tree(tree, workers_list, repeat=3):
+    """
+    :param tree:
+    :param workers_list: worker counts of the walker
+    :param repeat:
+    :return: [(method, workers, seconds, files/s, MB/s, code lines)]
+    """
+    sizes = {'shell': _selected_size(tree), 'walker': _counted_size(tree)}
+    cmd = shell_pipeline(tree, LANGUAGES[LANGUAGE].suffixes)
+    rows = []
+
+    def run_shell():
+        return int(subprocess.check_output(cmd, shell=True).strip())
+
+    runs = [('shell', '-', run_shell)]
+    for workers in workers_list:
+        runs.append(('walker', workers, lambda w=workers: walk_dir(tree, LANGUAGE, workers=w)[1]['code']))
+    for method, workers, run in runs:
+        best, code = None, None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            code = run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        best = max(best, 1e-9)
+        files, size = sizes[method]
+        rows.append((method, workers, best, files / best, size / best / (1 << 20), code))
+    return rows
+
+
+def _counted_size(tree):
+    """number and total size of the files the walker counts, pruned ones left out"""
+    file_counts, _ = walk_dir(tree, LANGUAGE, workers=1)
+    return len(file_counts), sum(os.path.getsize(fc.path) for fc in file_counts)
+
+
+def _selected_size(tree):
+    """number and total size of the files the shell pipeline reads"""
+    endings = tuple('.' + s for s in LANGUAGES[LANGUAGE].suffixes)
+    files = size = 0
+    for dir_path, _, names in os.walk(tree):
+        for name in names:
+            if name.endswith(endings):
+                files += 1
+                size += os.path.getsize(os.path.join(dir_path, name))
+    return files, size
+
+
+if __name__ == '__main__':
+    main()
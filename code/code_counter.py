@@ -2,77 +2,1209 @@
 """
 python code_counter.py [OPTIONS] PROJECT_ROOT_DIR
 
+PROJECT_ROOT_DIR may also be a single file, or a .tar(.gz/.bz2/.xz) or .zip
+archive, its members are counted without extracting it.
+
 Options:
 -p        Python files only, deafult value
 -j        Java files only
 -g        Golang files only
 -c        C/C++ files only
+-a        all languages in one walk, by suffix, file name and shebang
+-w N      number of worker processes, defaults to cpu count
+--shell   count by the old "find | xargs grep | wc" pipeline
+--cloc    split code, comment and blank lines
+--cache FILE  incremental count cache, only changed files are read
+--lang-map FILE  json mapping of suffixes/file names to languages, {".pyx": "python"}
+--exclude PATTERN  skip paths matching the gitignore style pattern, repeatable
+--no-ignore  do not honor .gitignore/.ignore files
+--no-sniff  count binary, generated and minified files too, they are skipped by their first block
+--format jsonl|csv  stream a record per file as it is counted, then per directory rollups
+--dupes   also report blocks of lines repeated across the tree, whitespace ignored
+--min-lines K  with --dupes, shortest block reported, in non-blank lines, defaults to 6
+--rev REV  count the tree of a git commit from git objects, without checkout
+--history N|tags  code lines over N commits sampled along --rev (HEAD), or over all tags
+--watch   keep counting, only files touched since are counted again
+--serve PORT  with --watch, serve the totals as json over http
+--polling  with --watch, scan the tree every --interval seconds instead of using inotify
 """
 import sys
 import os
+import errno
+import re
+import csv
+import json
+import time
+import copy
+import mmap
+import threading
 import platform
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
+from itertools import chain
+from optparse import OptionParser
+
+from archive_source import ArchiveError, ArchiveReader, is_archive, list_members, stream_members
+from count_cache import CountCache, BlobCache
+from dupes import DupeIndex, WindowHasher, find_shard, MIN_LINES
+from watcher import InotifyWatcher, PollingWatcher, serve_json
+from git_source import (CatFile, GitError, ls_tree, first_parent_commits, tagged_commits, sample,
+                        MAX_BATCH)
+from ignore_rules import IgnoreRules, PathFilter, IGNORE_FILES
+from languages import (LANGUAGES, SUFFIXES, FILENAMES, SNIFF_SIZE, LineClassifier, detect_language_by_name,
+                       detect_shebang, load_lang_map, sniff_head)
+
+FILE_TYPES = {
+    '-p': 'python',
+    '-j': 'java',
+    '-g': 'go',
+    '-c': 'c',
+    '-a': None,
+}
+# files handed to a worker process at once, and batches in flight per worker
+BATCH_SIZE = 256
+BATCHES_PER_WORKER = 4
+# plain line counting: files from MMAP_THRESHOLD on are memory-mapped,
+# both paths scan BUFFER_SIZE (page aligned) windows
+MMAP_THRESHOLD = 1 << 22
+BUFFER_SIZE = 1 << 20
+_NEWLINE_RUN = re.compile(br'\n\n+')
+
+FileCount = namedtuple('FileCount', ['path', 'language', 'lines', 'blank', 'comment', 'code'])
+# a file left out by sniff_head(), reason is 'binary', 'generated' or 'minified'
+Skipped = namedtuple('Skipped', ['path', 'language', 'reason'])
+# columns of --format csv
+RECORD_FIELDS = ('type', 'path', 'language', 'files', 'lines', 'blank', 'comment', 'code', 'reason')
+
+# `git cat-file --batch` readers of a worker process, by repository
+_CAT_FILES = {}
+# ArchiveReader of a worker process, by archive path
+_ARCHIVES = {}
 
 
 def main():
     """"""
-    # sys.argv = ['file', '-p', '.']
-    option, project_path = parse_args(*sys.argv[1:])
-    file_type = {
-        '-p': 'py',
-        '-j': 'java',
-        '-g': 'go',
-        '-c': '{c, cpp}'
-    }.get(option)
-    if platform.system() in ('Linux', 'Darwin'):
-        shell_cmd(project_path, file_type)
+    options, project_path = parse_args(*sys.argv[1:])
+    if not os.path.exists(project_path):
+        sys.stderr.write('No such file or directory: {}\n'.format(project_path))
+        sys.exit(-1)
+    if options.watch and not os.path.isdir(project_path):
+        sys.stderr.write('--watch works on a directory only\n')
+        sys.exit(-1)
+    language = FILE_TYPES[options.file_type]
+    lang_map = None
+    if options.lang_map:
+        with open(options.lang_map) as f:
+            lang_map = json.load(f)
+        try:
+            load_lang_map(lang_map)
+        except ValueError as e:
+            sys.stderr.write('{}\n'.format(e))
+            sys.exit(-1)
+    if options.shell:
+        suffixes = LANGUAGES[language].suffixes if language else sorted(SUFFIXES)
+        if platform.system() in ('Linux', 'Darwin'):
+            shell_cmd(project_path, suffixes)
+        return
+    cache = None
+    if options.cache:
+        mode = 'cloc' if options.cloc else 'lines'
+        if options.no_sniff:
+            mode += ':no-sniff'
+        if lang_map:
+            mode += ':' + json.dumps(lang_map, sort_keys=True)
+        cache = (BlobCache if options.rev or options.history else CountCache)(options.cache, mode=mode)
+    if options.dupes and (options.watch or options.history or options.rev or options.format or
+                          is_archive(project_path)):
+        sys.stderr.write('--dupes works on a directory walk only, without --watch, --history, --rev and --format\n')
+        sys.exit(-1)
+    if options.watch:
+        # totals are changed in place by the main thread, a copy is served
+        served = [{}]
+        served_lock = threading.Lock()
+
+        def get_served():
+            with served_lock:
+                return served[0]
+
+        if options.serve:
+            serve_json(options.serve, get_served)
+
+        def on_update(total):
+            snapshot = copy.deepcopy(total)
+            with served_lock:
+                served[0] = snapshot
+            print('{} files:{} code:{} comment:{} blank:{}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S'), total['files'], total['code'], total['comment'],
+                total['blank']))
+            sys.stdout.flush()
+
+        try:
+            watch(project_path, language, workers=options.workers, classify=options.cloc, lang_map=lang_map,
+                  excludes=options.excludes, ignore_files=() if options.no_ignore else IGNORE_FILES,
+                  interval=options.interval, on_update=on_update, polling=options.polling,
+                  sniff=not options.no_sniff)
+        except KeyboardInterrupt:
+            pass
+        return
+    if options.history:
+        try:
+            series = walk_history(project_path, history_samples(project_path, options.history,
+                                                                options.rev or 'HEAD'),
+                                  language, workers=options.workers, cache=cache, classify=options.cloc,
+                                  lang_map=lang_map, excludes=options.excludes, sniff=not options.no_sniff)
+        except (GitError, ValueError) as e:
+            sys.stderr.write('{}\n'.format(e))
+            sys.exit(-1)
+        if cache is not None:
+            cache.save()
+        print(format_history(series))
+        return
+    sniff = not options.no_sniff
+    if is_archive(project_path):
+        root = ''
+        file_counts = iter_archive_counts(project_path, language, workers=options.workers, classify=options.cloc,
+                                          lang_map=lang_map, excludes=options.excludes, sniff=sniff)
+    elif options.rev:
+        root = ''
+        file_counts = iter_rev_counts(project_path, options.rev, language, workers=options.workers, cache=cache,
+                                      classify=options.cloc, lang_map=lang_map, excludes=options.excludes,
+                                      sniff=sniff)
+    else:
+        root = project_path
+        if options.dupes:
+            # cached files are not read, their lines could not be hashed
+            cache = None
+        file_counts = iter_counts(project_path, language, workers=options.workers, cache=cache,
+                                  classify=options.cloc, lang_map=lang_map, excludes=options.excludes,
+                                  ignore_files=() if options.no_ignore else IGNORE_FILES, sniff=sniff,
+                                  min_lines=options.min_lines if options.dupes else None)
+    dupe_index = DupeIndex() if options.dupes else None
+    if dupe_index is not None:
+        file_counts = dupe_index.collect(file_counts)
+    try:
+        if options.format:
+            write_records(iter_records(file_counts, root), options.format, sys.stdout)
+        else:
+            _, total = summarize(file_counts)
+    except (ArchiveError, GitError, OSError) as e:
+        sys.stderr.write('{}\n'.format(e))
+        if dupe_index is not None:
+            dupe_index.close()
+        sys.exit(-1)
+    if cache is not None:
+        cache.save()
+    if options.format:
+        return
+    if options.cloc or language is None:
+        print(format_table(total))
     else:
-        pass
+        print(total['code'])
+        if total.get('skipped'):
+            # not in the number, said apart from it
+            sys.stderr.write('{}\n'.format(format_skipped(total['skipped'])))
+    if dupe_index is not None:
+        print(format_dupes(dupe_index.find(CountPool(options.workers, find_shard))))
 
 
 def parse_args(*args):
     """"""
-    options = ('-p', '-j', '-g', '-c')
-    default_option = '-p'
-    args_len = len(args)
-    if args_len == 1:
-        project_path = args[0]
-        option = default_option
-    elif args_len == 2:
-        option, project_path = args
-        if option not in options:
-            sys.stderr.write('Unknow option: "{}"\n'.format(option))
-            print(usage())
-            sys.exit(-1)
-    else:
+    parser = OptionParser(usage="\n\tpython code_counter.py [OPTIONS] PROJECT_ROOT_DIR",
+                          prog="code_counter",
+                          add_help_option=True)
+    for option, language in sorted(FILE_TYPES.items()):
+        parser.add_option(option, dest='file_type', action='store_const', const=option,
+                          help='{} files only'.format(language or 'all languages'))
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=None,
+                      help='number of worker processes, defaults to cpu count')
+    parser.add_option('--shell', dest='shell', action='store_true', default=False,
+                      help='count by shell pipeline: find | xargs grep | wc')
+    parser.add_option('--cloc', dest='cloc', action='store_true', default=False,
+                      help='split code, comment and blank lines')
+    parser.add_option('--cache', dest='cache', metavar='FILE', default=None,
+                      help='incremental count cache, only changed files are read')
+    parser.add_option('--lang-map', dest='lang_map', metavar='FILE', default=None,
+                      help='json mapping of suffixes/file names to languages')
+    parser.add_option('--exclude', dest='excludes', metavar='PATTERN', action='append', default=[],
+                      help='skip paths matching the gitignore style pattern, repeatable')
+    parser.add_option('--no-ignore', dest='no_ignore', action='store_true', default=False,
+                      help='do not honor .gitignore/.ignore files')
+    parser.add_option('--format', dest='format', metavar='FORMAT', type='choice', choices=['jsonl', 'csv'],
+                      default=None, help='stream a record per file, then per directory rollups: jsonl or csv')
+    parser.add_option('--dupes', dest='dupes', action='store_true', default=False,
+                      help='also report blocks of lines repeated across the tree')
+    parser.add_option('--min-lines', dest='min_lines', metavar='K', type='int', default=MIN_LINES,
+                      help='with --dupes, shortest block reported, in non-blank lines, defaults to {}'.format(
+                          MIN_LINES))
+    parser.add_option('--no-sniff', dest='no_sniff', action='store_true', default=False,
+                      help='count binary, generated and minified files too')
+    parser.add_option('--rev', dest='rev', metavar='REV', default=None,
+                      help='count the tree of a git commit from git objects, without checkout')
+    parser.add_option('--watch', dest='watch', action='store_true', default=False,
+                      help='keep counting, only files touched since are counted again')
+    parser.add_option('--serve', dest='serve', metavar='PORT', type='int', default=None,
+                      help='with --watch, serve the totals as json over http')
+    parser.add_option('--interval', dest='interval', metavar='SECONDS', type='float', default=1.0,
+                      help='with --watch, seconds between scans when polling, defaults to 1')
+    parser.add_option('--polling', dest='polling', action='store_true', default=False,
+                      help='with --watch, scan the tree instead of using inotify')
+    parser.add_option('--history', dest='history', metavar='N|tags', default=None,
+                      help='code lines over N commits sampled along --rev (HEAD), or over all tags')
+    parser.set_defaults(file_type='-p')
+    options, rest = parser.parse_args(list(args))
+    invalid = IgnoreRules('', options.excludes).invalid
+    if invalid:
+        parser.error('--exclude pattern never matches: {}'.format(invalid[0]))
+    if options.min_lines < 2:
+        parser.error('--min-lines must be at least 2')
+    if len(rest) != 1:
         print(usage())
         sys.exit(-1)
-    return option, project_path
+    return options, rest[0]
+
+
+def shell_cmd(_project_path, _suffixes):
+    """"""
+    os.system(shell_pipeline(_project_path, _suffixes))
+
+
+def shell_pipeline(_project_path, _suffixes):
+    """
+    :return: the "find | xargs grep | wc" command line
+    """
+    CMD = """find {path} \\( {names} \\) |xargs grep -v "^$"|wc -l"""
+    names = ' -o '.join('-name "*.{}"'.format(s) for s in _suffixes)
+    return CMD.format(path=_project_path, names=names)
+
+
+def walk_dir(project_path, language=None, workers=None, cache=None, classify=False, lang_map=None,
+             excludes=(), ignore_files=IGNORE_FILES, sniff=True):
+    """
+    count all matched files under project_path on a process pool
+    :param project_path:
+    :param language: name in LANGUAGES to count its files only, None for all known languages
+    :param workers: worker processes, None for cpu count, 1 to count in-process
+    :param cache: CountCache, unchanged files are taken from it instead of being read
+    :param classify: split code/comment/blank, otherwise count lines and empty lines only
+    :param lang_map: extra mapping table for load_lang_map(), applied in worker processes
+    :param excludes: gitignore style patterns, relative to project_path
+    :param ignore_files: names of ignore files honored in every directory, () for none
+    :param sniff: skip binary, generated and minified files by their first block
+    :return: (list of FileCount, aggregate dict with per language aggregates in 'languages'
+        and numbers of skipped files by reason in 'skipped')
+    """
+    return summarize(iter_counts(project_path, language, workers=workers, cache=cache,
+                                 classify=classify, lang_map=lang_map, excludes=excludes,
+                                 ignore_files=ignore_files, sniff=sniff))
+
+
+def walk_archive(archive, language=None, workers=None, classify=False, lang_map=None, excludes=(), sniff=True):
+    """
+    count members of a tar(.gz/.bz2/.xz) or zip archive without extracting it;
+    like walk_dir(), with member names as paths
+    :param archive: path of the archive
+    :return:
+    """
+    return summarize(iter_archive_counts(archive, language, workers=workers, classify=classify,
+                                         lang_map=lang_map, excludes=excludes, sniff=sniff))
+
+
+def walk_rev(project_path, rev, language=None, workers=None, cache=None, classify=False, lang_map=None,
+             excludes=(), sniff=True):
+    """
+    count the tree of a git commit from git objects, without checkout;
+    like walk_dir(), with paths relative to the top of the repository
+    :param project_path: any directory in the repository
+    :param rev: commit, tag or branch
+    :param cache: BlobCache, each distinct blob is counted once
+    :return:
+    """
+    return summarize(iter_rev_counts(project_path, rev, language, workers=workers, cache=cache,
+                                     classify=classify, lang_map=lang_map, excludes=excludes, sniff=sniff))
+
+
+def history_samples(repo, history, rev='HEAD'):
+    """
+    :param repo:
+    :param history: number of commits to sample along the first parents of rev, or 'tags'
+    :param rev:
+    :return: [(label, commit sha, unix time)], oldest first
+    """
+    if history == 'tags':
+        return tagged_commits(repo)
+    try:
+        n = int(history)
+    except ValueError:
+        raise ValueError('--history takes a number or "tags", got: {}'.format(history))
+    return [(sha[:10], sha, timestamp) for sha, timestamp in sample(first_parent_commits(repo, rev), n)]
+
+
+def walk_history(repo, samples, language=None, workers=None, cache=None, classify=False, lang_map=None,
+                 excludes=(), sniff=True):
+    """
+    count sampled commits like walk_rev(), blobs are memoized across the whole
+    history, so each distinct blob is counted once
+    :param repo:
+    :param samples: [(label, commit sha, unix time)]
+    :param cache: BlobCache, an in-memory one is used if None
+    :return: [(label, commit sha, unix time, aggregate dict)]
+    """
+    if cache is None:
+        cache = BlobCache(None)
+    pool = CountPool(workers, partial(count_blob_batch, repo=repo, classify=classify, sniff=sniff), lang_map)
+    series = []
+    try:
+        for label, commit, timestamp in samples:
+            _, total = summarize(iter_rev_counts(repo, commit, language, cache=cache, excludes=excludes,
+                                                 pool=pool))
+            series.append((label, commit, timestamp, total))
+    finally:
+        pool.close()
+    return series
+
+
+def summarize(file_counts):
+    """
+    :param file_counts: iterable of FileCount and Skipped
+    :return: (list of FileCount, aggregate dict with per language aggregates in 'languages'
+        and numbers of skipped files by reason in 'skipped')
+    """
+    files = []
+    total = new_total()
+    total['languages'] = {}
+    total['skipped'] = {}
+    for fc in file_counts:
+        if isinstance(fc, Skipped):
+            total['skipped'][fc.reason] = total['skipped'].get(fc.reason, 0) + 1
+            continue
+        files.append(fc)
+        add_count(total, fc)
+        if fc.language not in total['languages']:
+            total['languages'][fc.language] = new_total()
+        add_count(total['languages'][fc.language], fc)
+    return files, total
+
+
+def new_total():
+    """"""
+    return {'files': 0, 'lines': 0, 'blank': 0, 'comment': 0, 'code': 0}
+
+
+def add_count(total, fc, sign=1):
+    """"""
+    total['files'] += sign
+    total['lines'] += sign * fc.lines
+    total['blank'] += sign * fc.blank
+    total['comment'] += sign * fc.comment
+    total['code'] += sign * fc.code
+
+
+class LiveTotals(object):
+    """per file counts and the aggregate dict of summarize(), updated in place"""
+
+    def __init__(self):
+        self.files = {}
+        self.total = new_total()
+        self.total['languages'] = {}
+        self.total['skipped'] = {}
+
+    def update(self, fc):
+        """"""
+        self.remove(fc.path)
+        self.files[fc.path] = fc
+        if isinstance(fc, Skipped):
+            self.total['skipped'][fc.reason] = self.total['skipped'].get(fc.reason, 0) + 1
+            return
+        add_count(self.total, fc)
+        if fc.language not in self.total['languages']:
+            self.total['languages'][fc.language] = new_total()
+        add_count(self.total['languages'][fc.language], fc)
+
+    def remove(self, path):
+        """"""
+        fc = self.files.pop(path, None)
+        if fc is None:
+            return
+        if isinstance(fc, Skipped):
+            self.total['skipped'][fc.reason] -= 1
+            if not self.total['skipped'][fc.reason]:
+                del self.total['skipped'][fc.reason]
+            return
+        add_count(self.total, fc, -1)
+        language_total = self.total['languages'][fc.language]
+        add_count(language_total, fc, -1)
+        if not language_total['files']:
+            del self.total['languages'][fc.language]
+
+    def remove_tree(self, dir_path):
+        """"""
+        prefix = dir_path.rstrip(os.sep) + os.sep
+        for path in [p for p in self.files if p.startswith(prefix)]:
+            self.remove(path)
+
+
+def iter_counts(project_path, language=None, workers=None, cache=None, classify=False, lang_map=None,
+                excludes=(), ignore_files=IGNORE_FILES, sniff=True, min_lines=None):
+    """
+    yield FileCount of cached files at once, and of the others in completion order
+    :param project_path:
+    :param language:
+    :param workers:
+    :param cache:
+    :param classify:
+    :param lang_map:
+    :param excludes:
+    :param ignore_files:
+    :param sniff:
+    :param min_lines: also yield DupeWindows of as many lines, for DupeIndex; cache has to be None
+    :return:
+    """
+    path_filter = PathFilter(project_path, excludes, ignore_files)
+    suffixes, detect = _selection(language)
+    entries = iter_files(project_path, suffixes, detect=detect, path_filter=path_filter)
+    pool = CountPool(workers, partial(count_batch, language=language, classify=classify, sniff=sniff,
+                                      min_lines=min_lines), lang_map)
+    try:
+        for fc in _count_entries(entries, pool, cache):
+            yield fc
+    finally:
+        pool.close()
+
+
+def _selection(language):
+    """
+    :return: (suffixes, detect) for iter_files()
+    """
+    if language is None:
+        return SUFFIXES, True
+    return LANGUAGES[language].suffixes, False
+
+
+def _count_entries(entries, pool, cache=None):
+    """"""
+    batch = []
+    for entry in entries:
+        counts = cache.get(entry) if cache is not None else None
+        if counts is not None:
+            if counts:
+                yield _record(entry.path, counts)
+            continue
+        batch.append(entry.path)
+        if len(batch) >= BATCH_SIZE:
+            for fc in _cached(pool.submit(batch), cache):
+                yield fc
+            batch = []
+    if batch:
+        for fc in _cached(pool.submit(batch), cache):
+            yield fc
+    for fc in _cached(pool.drain(), cache):
+        yield fc
+    if cache is not None:
+        # unreadable or of unknown language, not opened again while unchanged
+        cache.put_uncounted()
+
+
+def iter_rev_counts(repo, rev, language=None, workers=None, cache=None, classify=False, lang_map=None,
+                    excludes=(), sniff=True, pool=None):
+    """
+    yield FileCount for blobs of the tree at rev, blobs are deduplicated by
+    sha and only those missing in cache are read, by a `git cat-file --batch`
+    stream per worker
+    :param repo:
+    :param rev:
+    :param language:
+    :param workers:
+    :param cache: BlobCache, an in-memory one is used if None
+    :param classify:
+    :param lang_map:
+    :param excludes:
+    :param sniff:
+    :param pool: CountPool of count_blob_batch to share, workers/classify/lang_map/sniff are ignored then
+    :return:
+    """
+    if cache is None:
+        cache = BlobCache(None)
+    path_filter = PathFilter('', excludes, ())
+    endings = tuple('.' + s for s in LANGUAGES[language].suffixes) if language else None
+    paths = {}  # (sha, language or None if it depends on the shebang) -> paths
+    for sha, path in ls_tree(repo, rev):
+        selected, guess = _guess_language(path, language, endings)
+        if selected and not path_filter.excluded(path):
+            paths.setdefault((sha, guess), []).append(path)
+
+    misses = [key for key in paths if key not in cache]
+    own_pool = pool is None
+    if own_pool:
+        pool = CountPool(workers, partial(count_blob_batch, repo=repo, classify=classify, sniff=sniff), lang_map)
+    try:
+        for i in range(0, len(misses), MAX_BATCH):
+            for key, counts in pool.submit(misses[i:i + MAX_BATCH]):
+                cache.put(key, counts)
+        for key, counts in pool.drain():
+            cache.put(key, counts)
+    finally:
+        if own_pool:
+            pool.close()
+    for key, key_paths in paths.items():
+        counts = cache.get(key)
+        if counts:
+            for path in key_paths:
+                yield _record(path, counts)
+
+
+def _guess_language(path, language, endings):
+    """
+    select a '/' separated path by name, for sources which are not walked
+    :param path:
+    :param language: language to count, None for all known languages
+    :param endings: suffixes of language with dot
+    :return: (selected, language name or None if it depends on the shebang)
+    """
+    if language is None:
+        guess = detect_language_by_name(path)
+        return guess is not None or '.' not in path.rpartition('/')[2], guess
+    return path.endswith(endings), language
+
+
+def iter_archive_counts(archive, language=None, workers=None, classify=False, lang_map=None, excludes=(),
+                        sniff=True):
+    """
+    yield FileCount for members of a tar or zip archive, with member names as
+    paths; nothing is extracted. Members of zip and plain tar archives are read
+    in place by a reader per worker, a compressed tar is streamed once, in-process.
+    :param archive: path of the archive
+    :param language:
+    :param workers:
+    :param classify:
+    :param lang_map:
+    :param excludes:
+    :param sniff:
+    :return:
+    """
+    path_filter = PathFilter('', excludes, ())
+    endings = tuple('.' + s for s in LANGUAGES[language].suffixes) if language else None
+    members = list_members(archive)
+    if members is None:
+        for name, chunks in stream_members(archive):
+            selected, guess = _guess_language(name, language, endings)
+            if selected and not path_filter.excluded(name):
+                fc = count_member(name, chunks, guess, classify, sniff)
+                if fc is not None:
+                    yield fc
+        return
 
+    selected_members = []
+    for name, ref in members:
+        selected, guess = _guess_language(name, language, endings)
+        if selected and not path_filter.excluded(name):
+            selected_members.append((ref, name, guess))
+    pool = CountPool(workers, partial(count_member_batch, archive=archive, classify=classify, sniff=sniff),
+                     lang_map)
+    try:
+        for i in range(0, len(selected_members), BATCH_SIZE):
+            for fc in pool.submit(selected_members[i:i + BATCH_SIZE]):
+                yield fc
+        for fc in pool.drain():
+            yield fc
+    finally:
+        pool.close()
 
-def shell_cmd(_project_path, _suffix):
+
+def _record(path, counts):
+    """FileCount or Skipped from counts as stored in a cache"""
+    return Skipped(path, *counts) if len(counts) == 2 else FileCount(path, *counts)
+
+
+def _cached(file_counts, cache):
     """"""
-    CMD = """find {path} -name "*.{suffix}" |xargs grep -v "^$"|wc -l"""
-    _cmd = CMD.format(path=_project_path, suffix=_suffix)
-    os.system(_cmd)
+    if cache is not None:
+        for fc in file_counts:
+            cache.put(fc.path, fc[1:])
+    return file_counts
+
+
+class CountPool(object):
+    """
+    count batches of files in-process (1 worker) or on a process pool,
+    with a bounded number of batches in flight
+    """
+
+    def __init__(self, workers, count, lang_map=None):
+        """
+        :param workers: None for cpu count
+        :param count: picklable function, taking a batch and returning a list of results
+        :param lang_map: applied in worker processes
+        """
+        self.workers = workers = workers or os.cpu_count() or 1
+        self._count = count
+        self._executor = None
+        if workers > 1:
+            self._executor = ProcessPoolExecutor(max_workers=workers, initializer=load_lang_map,
+                                                 initargs=(lang_map or {},))
+        self._pending = set()
+
+    def submit(self, batch):
+        """
+        :param batch:
+        :return: results of the batches finished by now
+        """
+        if self._executor is None:
+            return self._count(batch)
+        self._pending.add(self._executor.submit(self._count, batch))
+        if len(self._pending) < self.workers * BATCHES_PER_WORKER:
+            return []
+        done, self._pending = wait(self._pending, return_when=FIRST_COMPLETED)
+        return [fc for future in done for fc in future.result()]
+
+    def drain(self):
+        """wait for all batches in flight"""
+        pending, self._pending = self._pending, set()
+        return [fc for future in pending for fc in future.result()]
 
+    def close(self):
+        """"""
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
 
-def walk_dir(project_path):
+
+def iter_files(project_path, suffixes=None, detect=False, path_filter=None, chain=(), chains=None):
+    """
+    walk by os.scandir, symlinks are not followed; a directory which cannot be
+    read is reported on stderr and skipped, like find does
+    :param project_path: a regular file is yielded if selected, whatever the rules
+    :param suffixes:
+    :param detect: also files without suffix and known file names, for detect_shebang()
+    :param path_filter: PathFilter, ignored directories are not descended into
+    :param chain: ignore rules of the parent directories of project_path
+    :param chains: dict to record ignore rules of every directory walked
+    :return: os.DirEntry of files
+    :raise OSError: if project_path cannot be read
+    """
+    endings = tuple('.' + s for s in suffixes) if suffixes else None
+    if not os.path.isdir(project_path):
+        for entry in _file_entry(project_path):
+            if _selected(entry.name, endings, detect):
+                yield entry
+        return
+    stack = [(project_path, chain)]
+    while stack:
+        dir_path, chain = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError as e:
+            if dir_path == project_path:
+                raise
+            sys.stderr.write('{}\n'.format(e))
+            continue
+        if path_filter is not None:
+            chain = path_filter.enter(dir_path, [e.name for e in entries], chain)
+        if chains is not None:
+            chains[dir_path] = chain
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if path_filter is None or not path_filter.ignored(chain, entry.path, True):
+                        stack.append((entry.path, chain))
+                elif entry.is_file(follow_symlinks=False):
+                    if not _selected(entry.name, endings, detect):
+                        continue
+                    if path_filter is None or not path_filter.ignored(chain, entry.path, False):
+                        yield entry
+            except OSError:
+                continue
+
+
+def _file_entry(path):
+    """
+    :return: [os.DirEntry] of a regular file, found in its directory
+    :raise OSError: if it is missing or not a regular file
+    """
+    dir_path, name = os.path.split(path)
+    with os.scandir(dir_path or os.curdir) as it:
+        for entry in it:
+            if entry.name == name and entry.is_file(follow_symlinks=False):
+                return [entry]
+    raise FileNotFoundError(errno.ENOENT, 'No regular file', path)
+
+
+def _selected(name, endings, detect):
     """"""
-    pass
+    return endings is None or name.endswith(endings) or (detect and ('.' not in name or name in FILENAMES))
+
+
+def watch(project_path, language=None, workers=None, classify=False, lang_map=None, excludes=(),
+          ignore_files=IGNORE_FILES, interval=1.0, on_update=None, polling=False, sniff=True):
+    """
+    count once, then keep the totals up to date from file change events,
+    only touched files are counted again; runs until interrupted
+    :param interval: seconds to wait for events, or between scans when polling
+    :param on_update: called with the aggregate dict after the first count and after changes
+    :param polling: do not try inotify
+    :return:
+    """
+    suffixes, detect = _selection(language)
+    endings = tuple('.' + s for s in suffixes)
+    path_filter = PathFilter(project_path, excludes, ignore_files)
+    chains = {}
+    live = LiveTotals()
+
+    def scan(dir_path=project_path, chain=()):
+        """{path: (inode, size, mtime_ns)} of selected files, chains are recorded"""
+        if dir_path == project_path:
+            chains.clear()
+        snapshot = {}
+        for entry in iter_files(dir_path, suffixes, detect, path_filter, chain, chains):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                # gone since it was listed
+                continue
+            snapshot[entry.path] = (entry.inode(), st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def recount(paths):
+        """"""
+        if len(paths) < BATCH_SIZE:
+            file_counts = count_batch(paths, language, classify, sniff)
+        else:
+            file_counts = []
+            pool = CountPool(workers, partial(count_batch, language=language, classify=classify, sniff=sniff),
+                             lang_map)
+            try:
+                for i in range(0, len(paths), BATCH_SIZE):
+                    file_counts.extend(pool.submit(paths[i:i + BATCH_SIZE]))
+                file_counts.extend(pool.drain())
+            finally:
+                pool.close()
+        counted = set()
+        for fc in file_counts:
+            live.update(fc)
+            counted.add(fc.path)
+        for path in paths:
+            if path not in counted:
+                live.remove(path)
+
+    def rescan(watcher):
+        """
+        :return: False if not every directory could be watched
+        """
+        live.__init__()
+        recount(sorted(scan()))
+        return watch_dirs(watcher, list(chains))
+
+    def watch_dirs(watcher, dir_paths):
+        """"""
+        try:
+            for dir_path in dir_paths:
+                watcher.add_dir(dir_path)
+        except OSError as e:
+            sys.stderr.write('Cannot watch every directory, polling every {}s instead: {}\n'.format(interval, e))
+            return False
+        return True
+
+    def poll_instead(watcher):
+        """the totals are up to date, polling goes on from a new snapshot"""
+        watcher.close()
+        return PollingWatcher(scan)
+
+    if polling:
+        watcher = PollingWatcher(scan)
+        recount(sorted(watcher.snapshot))
+    else:
+        try:
+            watcher = InotifyWatcher()
+        except OSError:
+            watcher = PollingWatcher(scan)
+            recount(sorted(watcher.snapshot))
+        else:
+            if not rescan(watcher):
+                watcher = poll_instead(watcher)
+    if on_update:
+        on_update(live.total)
+    try:
+        while True:
+            changes, overflow = watcher.wait(interval)
+            if not changes and not overflow:
+                continue
+            if overflow or any(os.path.basename(p) in ignore_files for p in changes):
+                # ignore rules changed or events were lost
+                if not rescan(watcher):
+                    watcher = poll_instead(watcher)
+                if on_update:
+                    on_update(live.total)
+                continue
+            touched = []
+            for path, (is_dir, exists) in sorted(changes.items()):
+                parent = os.path.dirname(path)
+                if is_dir:
+                    live.remove_tree(path)
+                    for dir_path in [d for d in chains if d == path or d.startswith(path + os.sep)]:
+                        del chains[dir_path]
+                    if exists and parent in chains and not path_filter.ignored(chains[parent], path, True):
+                        touched.extend(scan(path, chains[parent]))
+                        if not watch_dirs(watcher, [d for d in chains if d == path or d.startswith(path + os.sep)]):
+                            watcher = poll_instead(watcher)
+                elif (exists and parent in chains and _selected(os.path.basename(path), endings, detect) and
+                      not path_filter.ignored(chains[parent], path, False)):
+                    touched.append(path)
+                else:
+                    live.remove(path)
+            recount(touched)
+            if on_update:
+                on_update(live.total)
+    finally:
+        watcher.close()
+
+
+def count_batch(paths, language=None, classify=False, sniff=True, min_lines=None):
+    """
+    run in worker process
+    :param min_lines: also hash windows of as many lines for --dupes, a DupeWindows is added
+    """
+    if not min_lines:
+        return [fc for fc in (count_file(p, language, classify, sniff) for p in paths) if fc is not None]
+    hasher = WindowHasher(min_lines)
+    results = [fc for fc in (count_file(p, language, classify, sniff, partial(hasher.tap, i))
+                             for i, p in enumerate(paths)) if fc is not None]
+    results.append(hasher.result(paths))
+    return results
+
+
+def count_file(path, language=None, classify=False, sniff=True, tap=None):
+    """
+    the first block is read once, for the shebang, for sniffing and for counting
+    :param path:
+    :param language: name in LANGUAGES, None to detect it
+    :param classify: split code/comment/blank, otherwise count lines and empty lines only
+    :param sniff: skip binary, generated and minified files, only their first block is read
+    :param tap: function passing the chunks of the file through, on their way to counting
+    :return: FileCount, Skipped, None if file is unreadable or of unknown language
+    """
+    if language is None:
+        language = detect_language_by_name(path)
+        if language is None and '.' in os.path.basename(path):
+            return None
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(SNIFF_SIZE)
+            if language is None:
+                language = detect_shebang(head)
+                if language is None:
+                    return None
+            if sniff:
+                reason = sniff_head(head)
+                if reason is not None:
+                    return Skipped(path, language, reason)
+            chunks = chain([head], _file_windows(f))
+            if tap is not None:
+                chunks = tap(chunks)
+            counts = count_stream(chunks, language, classify)
+    except (OSError, ValueError):
+        return None
+    return FileCount(path, language, *counts)
+
+
+def count_member_batch(members, archive, classify=False, sniff=True):
+    """
+    run in worker process
+    :param members: [(ref from list_members(), member name, language or None to detect it by shebang)]
+    :param archive:
+    :param classify:
+    :param sniff:
+    :return: [FileCount or Skipped]
+    """
+    reader = _ARCHIVES.get(archive)
+    if reader is None:
+        reader = _ARCHIVES[archive] = ArchiveReader(archive)
+    results = []
+    for (_, name, language), (_, chunks) in zip(members, reader.members([m[0] for m in members])):
+        fc = count_member(name, chunks, language, classify, sniff)
+        if fc is not None:
+            results.append(fc)
+    return results
+
+
+def count_member(name, chunks, language=None, classify=False, sniff=True):
+    """
+    :param name: path of the member
+    :param chunks: iterable of bytes
+    :param language: name in LANGUAGES, None to detect it by shebang
+    :param classify:
+    :param sniff:
+    :return: FileCount, Skipped, None if of unknown language
+    """
+    if language is None or sniff:
+        chunks = iter(chunks)
+        head = next(chunks, b'')
+        chunks = chain([head], chunks)
+        if language is None:
+            language = detect_shebang(head)
+            if language is None:
+                return None
+        if sniff:
+            reason = sniff_head(head[:SNIFF_SIZE])
+            if reason is not None:
+                return Skipped(name, language, reason)
+    return FileCount(name, language, *count_stream(chunks, language, classify))
+
+
+def count_blob_batch(keys, repo, classify=False, sniff=True):
+    """
+    run in worker process
+    :param keys: [(blob sha, language or None to detect it by shebang)]
+    :param repo:
+    :param classify:
+    :param sniff:
+    :return: [(key, (language, lines, blank, comment, code))], counts are
+        (language, reason) for skipped blobs and () for blobs of unknown language
+    """
+    reader = _CAT_FILES.get(repo)
+    if reader is None:
+        reader = _CAT_FILES[repo] = CatFile(repo)
+    results = []
+    for key, (sha, chunks) in zip(keys, reader.blobs([sha for sha, _ in keys])):
+        fc = count_member(sha, chunks, key[1], classify, sniff) if chunks is not None else None
+        results.append((key, fc[1:] if fc is not None else ()))
+    return results
+
+
+def count_stream(chunks, language, classify=False):
+    """
+    :param chunks: iterable of bytes
+    :param language: name in LANGUAGES
+    :param classify:
+    :return: (lines, blank, comment, code)
+    """
+    if classify:
+        classifier = LineClassifier(LANGUAGES[language])
+        for chunk in chunks:
+            classifier.feed(chunk)
+        blank, comment, code = classifier.close()
+        return blank + comment + code, blank, comment, code
+    lines, blank = _count_windows(chunks)
+    return lines, blank, 0, lines - blank
+
+
+def _file_windows(f):
+    """
+    BUFFER_SIZE windows of f from its current position, memory-mapped from MMAP_THRESHOLD on
+    """
+    start = f.tell()
+    size = os.fstat(f.fileno()).st_size
+    if size - start < MMAP_THRESHOLD:
+        return iter(partial(f.read, BUFFER_SIZE), b'')
+    return _mapped_windows(f, start, size)
+
+
+def _mapped_windows(f, start, size):
+    """"""
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if hasattr(m, 'madvise'):
+            m.madvise(mmap.MADV_SEQUENTIAL)
+        for i in range(start, size, BUFFER_SIZE):
+            yield m[i:i + BUFFER_SIZE]
+
+
+def _count_windows(windows):
+    """"""
+    lines = blank = 0
+    last = b''
+    # bytes before the window: b'\n' or b'\n\r' may be closed as an empty line
+    # by the window, the start of file acts as the end of a previous line
+    before = b'\n'
+    for window in windows:
+        lines += window.count(b'\n')
+        last = window[-1:]
+        if before == b'\n' and (window[:1] == b'\n' or window[:2] == b'\r\n'):
+            blank += 1
+        elif before == b'\n\r' and window[:1] == b'\n':
+            blank += 1
+        if last == b'\n':
+            before = b'\n'
+        elif window[-2:] == b'\n\r' or (window == b'\r' and before == b'\n'):
+            before = b'\n\r'
+        else:
+            before = b''
+        if b'\r' in window:
+            window = window.replace(b'\r\n', b'\n')
+        # a run of n newlines holds n - 1 empty lines
+        runs = _NEWLINE_RUN.findall(window)
+        blank += sum(map(len, runs)) - len(runs)
+    if last and last != b'\n':
+        lines += 1
+    return lines, blank
+
+
+def format_table(total):
+    """
+    :param total: aggregate dict of walk_dir()
+    :return: cloc like table, languages by code lines
+    """
+    fmt = '{:<16}{:>10}{:>10}{:>10}{:>10}'
+    sep = '-' * 56
+    lines = [sep, fmt.format('Language', 'files', 'blank', 'comment', 'code'), sep]
+    languages = sorted(total['languages'].items(), key=lambda item: (-item[1]['code'], item[0]))
+    for name, t in languages:
+        lines.append(fmt.format(name, t['files'], t['blank'], t['comment'], t['code']))
+    if len(languages) > 1:
+        lines.append(sep)
+        lines.append(fmt.format('SUM', total['files'], total['blank'], total['comment'], total['code']))
+    lines.append(sep)
+    if total.get('skipped'):
+        lines.append(format_skipped(total['skipped']))
+    return '\n'.join(lines)
+
+
+def format_skipped(skipped):
+    """
+    :param skipped: {reason: number of files}
+    :return:
+    """
+    return 'skipped: ' + ', '.join('{} {}'.format(n, reason) for reason, n in sorted(skipped.items()))
+
+
+def format_dupes(blocks):
+    """
+    :param blocks: [dupes.Block], longest first
+    :return: summary line and a line per duplicated block
+    """
+    lines = ['duplicated blocks: {}, lines: {}'.format(
+        len(blocks), sum(block.last_a - block.first_a + 1 for block in blocks))]
+    for block in blocks:
+        lines.append('{:>6} lines  {}:{}-{}  {}:{}-{}'.format(
+            block.last_a - block.first_a + 1, block.path_a, block.first_a, block.last_a,
+            block.path_b, block.first_b, block.last_b))
+    return '\n'.join(lines)
+
+
+def format_history(series):
+    """
+    :param series: of walk_history()
+    :return: table of code lines, a column per language
+    """
+    languages = {}
+    for _, _, _, total in series:
+        for name, t in total['languages'].items():
+            languages[name] = max(languages.get(name, 0), t['code'])
+    names = sorted(languages, key=lambda name: (-languages[name], name))
+    fmt = '{:<12}{:<24}' + '{:>12}' * (len(names) + 1)
+    lines = [fmt.format('date', 'rev', *(names + ['SUM']))]
+    for label, _, timestamp, total in series:
+        date = time.strftime('%Y-%m-%d', time.localtime(timestamp))
+        codes = [total['languages'].get(name, {}).get('code', 0) for name in names]
+        lines.append(fmt.format(date, label[:23], *(codes + [total['code']])))
+    return '\n'.join(lines)
+
+
+def iter_records(file_counts, root):
+    """
+    a record per file as soon as it is counted, then the rollups of all
+    directories, bottom-up; only per directory totals are kept, not the files
+    :param file_counts: iterable of FileCount and Skipped
+    :param root: directory the paths start with, '' for relative paths
+    :return: dicts with 'type' of 'file', 'skipped' or 'dir'
+    """
+    dirs = {}
+    for fc in file_counts:
+        if isinstance(fc, Skipped):
+            yield {'type': 'skipped', 'path': fc.path, 'language': fc.language, 'reason': fc.reason}
+            continue
+        yield {'type': 'file', 'path': fc.path, 'language': fc.language, 'files': 1, 'lines': fc.lines,
+               'blank': fc.blank, 'comment': fc.comment, 'code': fc.code}
+        dir_path = os.path.dirname(fc.path)
+        if dir_path not in dirs:
+            dirs[dir_path] = new_total()
+        add_count(dirs[dir_path], fc)
+    for dir_path, total in rollup(dirs, root):
+        record = {'type': 'dir', 'path': dir_path, 'language': None}
+        record.update(total)
+        yield record
+
+
+def rollup(dirs, root):
+    """
+    add up the totals of directories into their parents, in one pass from the
+    deepest level up to root
+    :param dirs: {directory: totals of the files right in it}, updated in place
+    :param root:
+    :return: (directory, totals of its tree), children before parents
+    """
+    root = root.rstrip(os.sep) or root
+    levels = {}
+    for dir_path in dirs:
+        levels.setdefault(_depth(dir_path), []).append(dir_path)
+    depth = max(levels) if levels else 0
+    while depth >= 0:
+        for dir_path in sorted(levels.pop(depth, ())):
+            total = dirs.pop(dir_path)
+            yield dir_path, total
+            parent = os.path.dirname(dir_path)
+            if dir_path == root or parent == dir_path:
+                continue
+            if parent not in dirs:
+                dirs[parent] = new_total()
+                levels.setdefault(_depth(parent), []).append(parent)
+            parent_total = dirs[parent]
+            for key in total:
+                parent_total[key] += total[key]
+        depth -= 1
+
+
+def _depth(dir_path):
+    """"""
+    return dir_path.count(os.sep) + 1 if dir_path else 0
+
+
+def write_records(records, fmt, out):
+    """
+    :param records: of iter_records()
+    :param fmt: 'jsonl' or 'csv'
+    :param out: text file, records are written one line each as they come
+    :return:
+    """
+    if fmt == 'csv':
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(RECORD_FIELDS)
+        for record in records:
+            writer.writerow([record.get(field, '') for field in RECORD_FIELDS])
+    else:
+        for record in records:
+            out.write(json.dumps(record) + '\n')
 
 
 def usage():
-    """"""      
+    """"""
     return '\n'.join([
         'Usage: ',
         '\tpython code_counter.py [OPTIONS] PROJECT_ROOT_DIR',
+        '\tPROJECT_ROOT_DIR may also be a single file, or a .tar(.gz/.bz2/.xz) or .zip archive, counted without '
+        'extracting',
         '\nOptions',
         '-p        Python files only, deafult value',
         '-j        Java files only',
         '-g        Golang files only',
-        '-c        C/C++ files only'
+        '-c        C/C++ files only',
+        '-a        all languages in one walk, by suffix, file name and shebang',
+        '-w N      number of worker processes, defaults to cpu count',
+        '--shell   count by the old "find | xargs grep | wc" pipeline',
+        '--cloc    split code, comment and blank lines',
+        '--cache FILE  incremental count cache, only changed files are read',
+        '--lang-map FILE  json mapping of suffixes/file names to languages, {".pyx": "python"}',
+        '--exclude PATTERN  skip paths matching the gitignore style pattern, repeatable',
+        '--no-ignore  do not honor .gitignore/.ignore files',
+        '--no-sniff  count binary, generated and minified files too, they are skipped by their first block',
+        '--format jsonl|csv  stream a record per file as it is counted, then per directory rollups',
+        '--dupes   also report blocks of lines repeated across the tree, whitespace ignored',
+        '--min-lines K  with --dupes, shortest block reported, in non-blank lines, defaults to 6',
+        '--rev REV  count the tree of a git commit from git objects, without checkout',
+        '--history N|tags  code lines over N commits sampled along --rev (HEAD), or over all tags',
+        '--watch   keep counting, only files touched since are counted again',
+        '--serve PORT  with --watch, serve the totals as json over http',
+        '--polling  with --watch, scan the tree every --interval seconds instead of using inotify',
     ])
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
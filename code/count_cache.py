@@ -0,0 +1,125 @@
+"""
+On-disk cache of per-file counts for code_counter.py
+
+An entry is valid while (path, inode, size, mtime_ns) of the file is unchanged,
+so later runs only open files that have changed since the last run.
+"""
+import os
+import pickle
+
+CACHE_VERSION = 4
+
+
+class CountCache(object):
+    """
+    path -> ((inode, size, mtime_ns), counts), counts are () for a file which
+    counted to nothing, unreadable or of unknown language;
+    entries not seen in the current run are dropped on save
+    """
+
+    def __init__(self, cache_file, mode='lines'):
+        self.cache_file = cache_file
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._entries = self._load()
+        self._seen = {}
+        self._keys = {}
+
+    def _load(self):
+        """"""
+        try:
+            with open(self.cache_file, 'rb') as f:
+                data = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return {}
+        if data.get('version') != CACHE_VERSION or data.get('mode') != self.mode:
+            return {}
+        return data['entries']
+
+    def get(self, entry):
+        """
+        :param entry: os.DirEntry of the file
+        :return: cached counts tuple, () if it counted to nothing, None if missing or stale
+        """
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            # gone since it was listed, a miss not recorded
+            self.misses += 1
+            return None
+        key = (entry.inode(), st.st_size, st.st_mtime_ns)
+        cached = self._entries.get(entry.path)
+        if cached is not None and cached[0] == key:
+            self.hits += 1
+            self._seen[entry.path] = cached
+            return cached[1]
+        self.misses += 1
+        self._keys[entry.path] = key
+        return None
+
+    def put(self, path, counts):
+        """record counts of a file missed by get()"""
+        key = self._keys.pop(path, None)
+        if key is not None:
+            self._seen[path] = (key, tuple(counts))
+
+    def put_uncounted(self):
+        """record () for the files missed by get() and not put since, once all are counted"""
+        for path, key in self._keys.items():
+            self._seen[path] = (key, ())
+        self._keys = {}
+
+    def save(self):
+        """write atomically, only entries seen in this run are kept"""
+        dirname = os.path.dirname(os.path.abspath(self.cache_file))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'mode': self.mode, 'entries': self._seen},
+                        f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.cache_file)
+        self._keys = {}
+
+
+class BlobCache(CountCache):
+    """
+    (blob sha, language) -> counts, for counting git objects
+
+    blobs are immutable, so entries never go stale and all of them are kept,
+    unchanged blobs of other revisions are never counted again;
+    without cache_file it is kept in memory only
+    """
+
+    def _load(self):
+        """"""
+        if self.cache_file is None:
+            return {}
+        return super(BlobCache, self)._load()
+
+    def get(self, key):
+        """
+        :param key: (blob sha, language)
+        :return: cached counts, None if missing
+        """
+        counts = self._entries.get(key)
+        if counts is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return counts
+
+    def put(self, key, counts):
+        """"""
+        self._entries[key] = counts
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def save(self):
+        """"""
+        if self.cache_file is None:
+            return
+        self._seen = self._entries
+        super(BlobCache, self).save()
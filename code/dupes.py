@@ -0,0 +1,228 @@
+"""
+Near-duplicate block detection for code_counter.py --dupes
+
+Lines are normalized (whitespace collapsed, blank and trivial lines dropped)
+and a rolling hash is taken over every window of K normalized lines, while
+the walk's worker reads the file for counting. Windows are packed into
+per-shard byte arrays by hash prefix and spilled to a file per shard; each
+shard is then searched for repeated hashes independently, on the same process
+pool. Most windows are unique, so a bit table of hashes seen twice is filled
+first, and only the windows it lets through are unpacked and sorted. Matching
+windows next to each other are merged into blocks.
+"""
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import deque, namedtuple
+from itertools import chain
+
+MIN_LINES = 6
+SHARD_BITS = 4
+# normalized lines shorter than this, e.g. '}' or '});', do not count
+MIN_LINE_LENGTH = 3
+
+_MOD = (1 << 61) - 1
+_BASE = 1000003
+_HASH_BITS = 61
+_RECORD = struct.Struct('<QIII')  # window hash, file number in batch, first line, last line
+_HASH = struct.Struct('<Q12x')  # window hash of a _RECORD
+_PART = struct.Struct('<II')  # in a shard file, ahead of the records of a batch: batch number, length
+# bits per window of the table of hashes seen twice, 1 in 16 unique windows gets through
+FILTER_BITS = 16
+
+# windows of a batch of files: paths, {shard: packed records}
+DupeWindows = namedtuple('DupeWindows', ['paths', 'shards'])
+# lines first..last of path_a repeat as first..last of path_b
+Block = namedtuple('Block', ['path_a', 'first_a', 'last_a', 'path_b', 'first_b', 'last_b'])
+
+
+class WindowHasher(object):
+    """hash the windows of the files of one batch, in a worker process"""
+
+    def __init__(self, min_lines=MIN_LINES):
+        self.min_lines = min_lines
+        self.shards = {}
+        self._top = pow(_BASE, min_lines - 1, _MOD)
+
+    def tap(self, file_no, chunks):
+        """
+        pass chunks through, hashing their lines on the way
+        :param file_no: number of the file in the batch
+        :param chunks: iterable of bytes
+        :return: the same chunks
+        """
+        carry = b''
+        line_no = 0
+        window = deque()  # (line hash, line number) of the current window
+        h = 0
+        k, top, shards = self.min_lines, self._top, self.shards
+        for chunk in chain(chunks, [None]):
+            if chunk is None:
+                # last line without newline
+                lines, carry = [carry], b''
+            else:
+                yield chunk
+                lines = (carry + chunk).split(b'\n')
+                carry = lines.pop()
+            for line in lines:
+                line_no += 1
+                line = b' '.join(line.split())
+                if len(line) < MIN_LINE_LENGTH:
+                    continue
+                lh = zlib.crc32(line) | (zlib.adler32(line) << 32)
+                if len(window) == k:
+                    h = (h - window.popleft()[0] * top) % _MOD
+                window.append((lh, line_no))
+                h = (h * _BASE + lh) % _MOD
+                if len(window) == k:
+                    shard = h >> (_HASH_BITS - SHARD_BITS)
+                    if shard not in shards:
+                        shards[shard] = bytearray()
+                    shards[shard] += _RECORD.pack(h, file_no, window[0][1], line_no)
+
+    def result(self, paths):
+        """"""
+        return DupeWindows(paths, dict((shard, bytes(data)) for shard, data in self.shards.items()))
+
+
+def find_shard(shard_file):
+    """
+    run in worker process
+    :param shard_file: of DupeIndex
+    :return: [[(batch number, file number, first line, last line)]], windows
+        with the same hash, at least two per group
+    """
+    with open(shard_file, 'rb') as f:
+        data = memoryview(f.read())
+    parts = []
+    offset = 0
+    while offset < len(data):
+        batch_no, length = _PART.unpack_from(data, offset)
+        offset += _PART.size
+        parts.append((batch_no, data[offset:offset + length]))
+        offset += length
+    slots = max(len(data) // _RECORD.size * FILTER_BITS, 64)
+    seen = bytearray(slots // 8 + 1)
+    again = bytearray(slots // 8 + 1)
+    for _, records in parts:
+        for h, in _HASH.iter_unpack(records):
+            i = h % slots
+            bit = 1 << (i & 7)
+            if seen[i >> 3] & bit:
+                again[i >> 3] |= bit
+            else:
+                seen[i >> 3] |= bit
+    del seen
+    # hashes seen twice, and a few unique ones sharing their bit
+    records = []
+    for batch_no, part in parts:
+        for h, file_no, first, last in _RECORD.iter_unpack(part):
+            i = h % slots
+            if again[i >> 3] & (1 << (i & 7)):
+                records.append((h, batch_no, file_no, first, last))
+    records.sort()
+    groups = []
+    i, n = 0, len(records)
+    while i < n:
+        j = i + 1
+        while j < n and records[j][0] == records[i][0]:
+            j += 1
+        if j - i > 1:
+            group = [r[1:] for r in records[i:j]]
+            # windows of a run of repeated lines match their own neighbours
+            if any(r[:2] != group[0][:2] or r[2] > group[0][3] for r in group[1:]):
+                groups.append(group)
+        i = j
+    return groups
+
+
+def merge_blocks(groups, path_of):
+    """
+    :param groups: of find_shard()
+    :param path_of: (batch number, file number) -> path
+    :return: [Block], overlapping windows of the same two files merged, longest first
+    """
+    pairs = []
+    for group in groups:
+        first = group[0]
+        for other in group[1:]:
+            if other[:2] == first[:2] and other[2] <= first[3]:
+                continue
+            pairs.append((first[:2], other[:2], first[2], first[3], other[2], other[3]))
+    pairs.sort()
+    blocks = []
+    current = None
+    for file_a, file_b, first_a, last_a, first_b, last_b in pairs:
+        if (current is not None and current[0] == file_a and current[1] == file_b and
+                first_a <= current[3] + 1 and current[4] <= first_b <= current[5] + 1):
+            current[3] = max(current[3], last_a)
+            current[5] = max(current[5], last_b)
+            continue
+        if current is not None:
+            blocks.append(current)
+        current = [file_a, file_b, first_a, last_a, first_b, last_b]
+    if current is not None:
+        blocks.append(current)
+    blocks = [Block(path_of(a), first_a, last_a, path_of(b), first_b, last_b)
+              for a, b, first_a, last_a, first_b, last_b in blocks]
+    blocks.sort(key=lambda block: (block.first_a - block.last_a, block.path_a, block.first_a))
+    return blocks
+
+
+class DupeIndex(object):
+    """collect the windows of all batches in a file per shard, then find the duplicates"""
+
+    def __init__(self, tmp_dir=None):
+        """
+        :param tmp_dir: where the shard files are made, defaults to the system's
+        """
+        self.batches = []
+        self.shards = {}  # shard -> file path
+        self._dir = tempfile.mkdtemp(prefix='dupes-', dir=tmp_dir)
+        self._files = {}
+
+    def collect(self, records):
+        """
+        take DupeWindows out of the records of a walk
+        :param records: iterable of FileCount, Skipped and DupeWindows
+        :return: the other records
+        """
+        for record in records:
+            if isinstance(record, DupeWindows):
+                batch_no = len(self.batches)
+                self.batches.append(record.paths)
+                for shard, data in record.shards.items():
+                    f = self._files.get(shard)
+                    if f is None:
+                        self.shards[shard] = os.path.join(self._dir, '{:x}'.format(shard))
+                        f = self._files[shard] = open(self.shards[shard], 'wb')
+                    f.write(_PART.pack(batch_no, len(data)))
+                    f.write(data)
+            else:
+                yield record
+
+    def find(self, pool):
+        """
+        :param pool: CountPool of find_shard, a shard per task
+        :return: [Block]
+        """
+        groups = []
+        try:
+            for f in self._files.values():
+                f.close()
+            for shard in sorted(self.shards):
+                groups.extend(pool.submit(self.shards[shard]))
+            groups.extend(pool.drain())
+        finally:
+            pool.close()
+            self.close()
+        return merge_blocks(groups, lambda key: self.batches[key[0]][key[1]])
+
+    def close(self):
+        """remove the shard files"""
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        shutil.rmtree(self._dir, ignore_errors=True)
@@ -0,0 +1,148 @@
+"""
+Read trees and blobs straight from git objects, without a checkout
+
+Blob contents come from one long-running `git cat-file --batch` process per
+reader, so a revision of any size costs a single `ls-tree` plus one stream.
+"""
+import subprocess
+
+READ_SIZE = 1 << 16
+# shas written to cat-file at once; a batch of requests (41 bytes each) must fit
+# the pipe buffer, as answers are only read after the whole batch is written
+MAX_BATCH = 256
+
+MODE_SYMLINK = b'120000'
+
+
+class GitError(Exception):
+    """"""
+    pass
+
+
+def git(repo, *args):
+    """
+    :param repo: any directory inside the work tree, or a bare repository
+    :param args:
+    :return: stdout bytes
+    """
+    proc = subprocess.Popen(('git',) + args, cwd=repo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise GitError('git {}: {}'.format(' '.join(args), err.decode('utf-8', 'replace').strip()))
+    return out
+
+
+def ls_tree(repo, rev):
+    """
+    regular blobs of the whole tree at rev, symlinks and submodules are skipped
+    :param repo:
+    :param rev:
+    :return: [(blob sha, path relative to top of the repository)]
+    """
+    out = git(repo, 'ls-tree', '-r', '-z', '--full-tree', rev)
+    blobs = []
+    for record in out.split(b'\0'):
+        if not record:
+            continue
+        meta, _, path = record.partition(b'\t')
+        mode, obj_type, sha = meta.split()
+        if obj_type != b'blob' or mode == MODE_SYMLINK:
+            continue
+        blobs.append((sha.decode('ascii'), path.decode('utf-8', 'surrogateescape')))
+    return blobs
+
+
+class CatFile(object):
+    """one `git cat-file --batch` process"""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._proc = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=repo,
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._pending = None
+
+    def blobs(self, shas):
+        """
+        :param shas: at most MAX_BATCH, all of them have to be iterated
+        :return: (sha, chunks) in request order, chunks is None for missing objects;
+            chunks of a blob must be consumed before the next one is yielded,
+            unconsumed chunks are skipped
+        """
+        self._finish()
+        stdin, stdout = self._proc.stdin, self._proc.stdout
+        stdin.write(b''.join(sha.encode('ascii') + b'\n' for sha in shas))
+        stdin.flush()
+        for sha in shas:
+            self._finish()
+            header = stdout.readline().split()
+            if len(header) != 3:
+                if not header:
+                    raise GitError('git cat-file exited unexpectedly')
+                yield sha, None
+                continue
+            self._pending = self._read(int(header[2]))
+            yield sha, self._pending
+        self._finish()
+
+    def _read(self, size):
+        """"""
+        while size > 0:
+            chunk = self._proc.stdout.read(min(size, READ_SIZE))
+            if not chunk:
+                raise GitError('git cat-file exited unexpectedly')
+            size -= len(chunk)
+            yield chunk
+
+    def _finish(self):
+        """skip the rest of the current blob and the LF after it"""
+        if self._pending is not None:
+            for _ in self._pending:
+                pass
+            self._proc.stdout.read(1)
+            self._pending = None
+
+    def close(self):
+        """"""
+        self._proc.stdin.close()
+        self._proc.wait()
+
+
+def first_parent_commits(repo, rev='HEAD'):
+    """
+    :return: [(commit sha, committer unix time)], oldest first
+    """
+    out = git(repo, 'rev-list', '--first-parent', '--reverse', '--format=%ct', rev)
+    lines = out.decode('ascii').split()
+    # "commit <sha>" header followed by the formatted line
+    return [(lines[i + 1], int(lines[i + 2])) for i in range(0, len(lines), 3)]
+
+
+def tagged_commits(repo):
+    """
+    :return: [(tag name, commit sha, unix time)], oldest first, tags not
+        pointing to commits are skipped
+    """
+    out = git(repo, 'for-each-ref', '--sort=creatordate',
+              '--format=%(refname:short)%00%(objecttype)%00%(objectname)%00'
+              '%(*objecttype)%00%(*objectname)%00%(creatordate:unix)', 'refs/tags')
+    tags = []
+    for line in out.decode('utf-8', 'replace').splitlines():
+        name, obj_type, sha, peeled_type, peeled_sha, timestamp = line.split('\0')
+        if peeled_type == 'commit':
+            sha = peeled_sha
+        elif obj_type != 'commit':
+            continue
+        tags.append((name, sha, int(timestamp or 0)))
+    return tags
+
+
+def sample(items, n):
+    """
+    :return: n items evenly spread, first and last included
+    """
+    if n >= len(items):
+        return list(items)
+    if n <= 1:
+        return list(items[-1:])
+    last = len(items) - 1
+    return [items[int(round(i * last / float(n - 1)))] for i in range(n)]
@@ -0,0 +1,204 @@
+"""
+.gitignore/.ignore rules for the code_counter walker
+
+Patterns of one directory are compiled into a single regex, with the rules in
+reverse order, so the first alternative that matches is the last rule of the
+file, which is the one that decides. Ignored directories are pruned before the
+walker descends into them.
+"""
+import os
+import re
+import sys
+
+IGNORE_FILES = ('.gitignore', '.ignore')  # later file takes precedence
+DEFAULT_EXCLUDES = ('.git/', '.hg/', '.svn/')
+
+
+def translate(pattern):
+    """
+    gitignore glob to regex, matching a '/' separated path relative to the ignore file
+    :param pattern: one line of the ignore file
+    :return: (regex string, negate, dir_only), None for blank lines and comments
+    """
+    pattern = pattern.rstrip('\r\n')
+    if pattern.endswith('\\ '):
+        pattern = pattern[:-2].rstrip(' ') + '\\ '
+    else:
+        pattern = pattern.rstrip(' ')
+    if not pattern or pattern.startswith('#'):
+        return None
+    negate = pattern.startswith('!')
+    if negate:
+        pattern = pattern[1:]
+    elif pattern.startswith(('\\!', '\\#')):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if not pattern:
+        return None
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/'):
+            if pattern.startswith('**/', i):
+                parts.append('(?:.*/)?')
+                i += 3
+                continue
+            if i + 2 == n:
+                parts.append('.*')
+                i += 2
+                continue
+        if c == '*':
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i + 2 if pattern.startswith(('[!', '[^'), i) else i + 1)
+            if j < 0:
+                parts.append('\\[')
+            else:
+                body = pattern[i + 1:j]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                parts.append('[' + body.replace('\\', '\\\\') + ']')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    prefix = '' if anchored else '(?:.*/)?'
+    return prefix + ''.join(parts), negate, dir_only
+
+
+class IgnoreRules(object):
+    """compiled rules of one directory, later rules take precedence"""
+
+    def __init__(self, base, patterns):
+        self.base = base
+        rules = []
+        # patterns git accepts but never matches, e.g. the range of '[z-a]'
+        self.invalid = []
+        for pattern in patterns:
+            rule = translate(pattern)
+            if rule is None:
+                continue
+            try:
+                re.compile(rule[0])
+            except re.error:
+                self.invalid.append(pattern.rstrip('\r\n'))
+                continue
+            rules.append(rule)
+        self._negate = [negate for _, negate, _ in rules]
+        # directories are matched by all rules, files by those without trailing '/'
+        self._dir_regex = self._compile([(i, r) for i, r in enumerate(rules)])
+        self._file_regex = self._compile([(i, r) for i, r in enumerate(rules) if not r[2]])
+
+    @staticmethod
+    def _compile(rules):
+        """"""
+        if not rules:
+            return None
+        alternatives = ['(?P<r{}>{})'.format(i, regex) for i, (regex, _, _) in reversed(rules)]
+        return re.compile('^(?:{})$'.format('|'.join(alternatives)), re.DOTALL)
+
+    def __bool__(self):
+        return self._dir_regex is not None
+
+    __nonzero__ = __bool__
+
+    def match(self, rel_path, is_dir):
+        """
+        :param rel_path: '/' separated path relative to base
+        :param is_dir:
+        :return: True if ignored, False if re-included by a negated rule, None if no rule matches
+        """
+        regex = self._dir_regex if is_dir else self._file_regex
+        if regex is None:
+            return None
+        m = regex.match(rel_path)
+        if m is None:
+            return None
+        return not self._negate[int(m.lastgroup[1:])]
+
+
+def read_rules(dir_path, names, ignore_files=IGNORE_FILES):
+    """
+    :param dir_path:
+    :param names: file names in dir_path
+    :param ignore_files:
+    :return: IgnoreRules, None if there are no ignore files with rules
+    """
+    patterns = []
+    for ignore_file in ignore_files:
+        if ignore_file not in names:
+            continue
+        try:
+            with open(os.path.join(dir_path, ignore_file), errors='replace') as f:
+                patterns.extend(f)
+        except OSError:
+            continue
+    rules = IgnoreRules(dir_path, patterns)
+    for pattern in rules.invalid:
+        sys.stderr.write('{}: never matching pattern skipped: {}\n'.format(dir_path, pattern))
+    return rules if rules else None
+
+
+class PathFilter(object):
+    """
+    decide which entries the walker skips: user excludes first, then ignore
+    files from the deepest directory up to the root
+    """
+
+    def __init__(self, root, excludes=(), ignore_files=IGNORE_FILES):
+        self.root = root
+        self.ignore_files = tuple(ignore_files)
+        self.excludes = IgnoreRules(root, list(DEFAULT_EXCLUDES) + list(excludes))
+        self._dirs = {}
+
+    def enter(self, dir_path, names, chain):
+        """
+        :param dir_path: directory being walked
+        :param names: file names in it
+        :param chain: rules of the parent directories
+        :return: rules for the entries of dir_path
+        """
+        if not self.ignore_files:
+            return chain
+        rules = read_rules(dir_path, names, self.ignore_files)
+        return chain + (rules,) if rules is not None else chain
+
+    def ignored(self, chain, path, is_dir):
+        """"""
+        if self.excludes.match(self._relative(self.root, path), is_dir):
+            return True
+        for rules in reversed(chain):
+            matched = rules.match(self._relative(rules.base, path), is_dir)
+            if matched is not None:
+                return matched
+        return False
+
+    def excluded(self, rel_path):
+        """
+        for paths not found by walking, e.g. from a git tree, parent directories are checked too
+        :param rel_path: '/' separated path relative to root
+        """
+        parts = rel_path.split('/')
+        for i in range(1, len(parts)):
+            dir_path = '/'.join(parts[:i])
+            if dir_path not in self._dirs:
+                self._dirs[dir_path] = bool(self.excludes.match(dir_path, True))
+            if self._dirs[dir_path]:
+                return True
+        return bool(self.excludes.match(rel_path, False))
+
+    @staticmethod
+    def _relative(base, path):
+        """"""
+        rel_path = path[len(base):].lstrip(os.sep)
+        return rel_path.replace(os.sep, '/') if os.sep != '/' else rel_path
@@ -0,0 +1,159 @@
+"""
+File change notification for code_counter.py --watch
+
+inotify through ctypes on Linux, a polling snapshot diff elsewhere. Both report
+{path: (is_dir, exists)} of what changed since the last call.
+"""
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import struct
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len of name
+# events keep coming while a file is being saved, wait a little for the rest
+SETTLE_TIME = 0.2
+
+
+class InotifyWatcher(object):
+    """
+    :raise OSError: if inotify is not available
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._dirs = {}  # watch descriptor -> directory
+
+    def add_dir(self, path):
+        """
+        :raise OSError: e.g. ENOSPC once fs.inotify.max_user_watches is reached
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            # gone already, its parent reports it
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(e, '{}: {}'.format(os.strerror(e), path))
+        self._dirs[wd] = path
+
+    def wait(self, timeout):
+        """
+        :param timeout: seconds
+        :return: ({path: (is_dir, exists)}, overflow), overflow means events were lost
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return {}, False
+        time.sleep(SETTLE_TIME)
+        changes = {}
+        overflow = False
+        while True:
+            try:
+                data = os.read(self._fd, 1 << 16)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                dir_path = self._dirs.get(wd)
+                if dir_path is None or not name:
+                    continue
+                exists = not mask & (IN_DELETE | IN_MOVED_FROM)
+                changes[os.path.join(dir_path, os.fsdecode(name))] = (bool(mask & IN_ISDIR), exists)
+        return changes, overflow
+
+    def close(self):
+        """"""
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+    """
+    compare snapshots of the tree, made by scan()
+    :param scan: returns {file path: (inode, size, mtime_ns)}
+    """
+
+    def __init__(self, scan):
+        self._scan = scan
+        self.snapshot = scan()
+
+    def add_dir(self, path):
+        """every directory is scanned anyway"""
+        pass
+
+    def wait(self, timeout):
+        """like InotifyWatcher.wait(), directories are not reported"""
+        time.sleep(timeout)
+        snapshot = self._scan()
+        changes = {}
+        for path, key in snapshot.items():
+            if self.snapshot.get(path) != key:
+                changes[path] = (False, True)
+        for path in self.snapshot:
+            if path not in snapshot:
+                changes[path] = (False, False)
+        self.snapshot = snapshot
+        return changes, False
+
+    def close(self):
+        """"""
+        pass
+
+
+def serve_json(port, get_data, host=''):
+    """
+    answer every GET with json of get_data(), in a daemon thread
+    :return: the server
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(get_data()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='totals-server')
+    thread.daemon = True
+    thread.start()
+    return server